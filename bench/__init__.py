@@ -0,0 +1,3 @@
+# Benchmarks for ingest and reporting, run from the repo root:
+#   python -m bench.run --scales 1000 100000
+# generate.py makes synthetic receipts, fake_ocr.py stands in for the ocr api
@@ -0,0 +1,102 @@
+import json
+import random
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+from bench import generate
+
+# Local stand-in for https://ocr.asprise.com/api/v1/receipt. Every POST gets a
+# generated receipt back after a tunable delay, and a tunable share of calls
+# fail with 503 or 429 or hang past the client timeout
+
+class FakeOCR(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=8765, latency=0.5, jitter=0.2, error_rate=0.0,
+                 throttle_rate=0.0, hang_rate=0.0, hang=15.0, seed=0):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.hang_rate = hang_rate
+        self.hang = hang
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {'ok': 0, 'error': 0, 'throttled': 0, 'hung': 0}
+
+    def roll(self):
+        with self.lock:
+            return self.rng.random(), self.rng.uniform(-self.jitter, self.jitter)
+
+    def count(self, outcome):
+        with self.lock:
+            self.calls[outcome] += 1
+
+    def start(self):
+        # serves from a background thread, call shutdown() to stop
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/api/v1/receipt'
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        roll, jitter = server.roll()
+        if roll < server.hang_rate:
+            server.count('hung')
+            sleep(server.hang)
+        elif roll < server.hang_rate + server.error_rate:
+            server.count('error')
+            return self.reply(503, b'')
+        elif roll < server.hang_rate + server.error_rate + server.throttle_rate:
+            server.count('throttled')
+            return self.reply(429, b'')
+        sleep(max(0.0, server.latency + jitter))
+        # the same image always gets the same receipt back
+        n = zlib.crc32(body)
+        jobj = next(generate.responses(1, seed=server.seed, merchants=5,
+                                       catalog_size=200, start=n % 1000000))
+        server.count('ok')
+        self.reply(200, json.dumps(jobj).encode())
+
+    def reply(self, status, data):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Fake OCR api for benchmarks')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds per call')
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503s')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of 429s')
+    parser.add_argument('--hang-rate', type=float, default=0.0,
+                        help='share of calls that sleep --hang seconds first')
+    parser.add_argument('--hang', type=float, default=15.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    server = FakeOCR(args.port, args.latency, args.jitter, args.error_rate,
+                     args.throttle_rate, args.hang_rate, args.hang, args.seed)
+    print(f'Fake OCR api on {server.url}, use ocr_api.py --url {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.calls)
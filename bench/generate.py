@@ -0,0 +1,121 @@
+import datetime
+import json
+import os
+import random
+
+# Synthetic receipts shaped like the Asprise api response. The same seed
+# always gives the same receipts so benchmark runs can be compared
+
+MERCHANTS = ('COSTCO WHOLESALE', 'SAFEWAY', 'FRED MEYER', 'TRADER JOES',
+             'WHOLE FOODS MARKET', 'TARGET', 'QFC', 'WINCO FOODS')
+WORDS = ('ORGANIC', 'KS', 'BANANAS', 'MILK', 'EGGS', 'BREAD', 'COFFEE', 'DOG',
+         'KIBBLE', 'CHICKEN', 'RICE', 'APPLES', 'CHEESE', 'YOGURT', 'PASTA',
+         'SAUCE', 'TOWELS', 'SOAP', 'BERRIES', 'SALMON', 'BEANS', 'OIL', 'SALT')
+START = datetime.datetime(2020, 1, 1, 8, 0, 0)
+DISCOUNT_RATE = 0.08 # chance an item has a discount line under it
+
+def merchant_name(n):
+    return f'{MERCHANTS[n % len(MERCHANTS)]} #{n // len(MERCHANTS) + 1}'
+
+def catalog(rng, size):
+    # item descriptions with prices, a few common words per description
+    items = set()
+    while len(items) < size:
+        words = rng.sample(WORDS, rng.randint(1, 3))
+        items.add(' '.join(words) + f' {rng.randint(1, 999)}')
+    return [(d, round(rng.lognormvariate(1.5, 0.8), 2)) for d in sorted(items)]
+
+def response(rng, n, merchant, items, items_per_receipt):
+    """
+        one api response for receipt number n. trip datetimes go up with n
+        so they never repeat
+    """
+    lines = []
+    # a few products are bought far more often than the rest
+    k = max(1, int(rng.gauss(items_per_receipt, items_per_receipt / 3)))
+    for description, price in (items[int(len(items) * rng.random() ** 3)]
+                               for _ in range(k)):
+        qty = rng.choice((1, 1, 1, 1, 2, 3))
+        amount = round(price * qty, 2)
+        lines.append({'amount': amount, 'description': description, 'flags': '',
+                      'qty': qty, 'remarks': None, 'tags': None,
+                      'unitPrice': price if qty > 1 else None})
+        if rng.random() < DISCOUNT_RATE:
+            lines.append({'amount': -round(amount * rng.choice((0.1, 0.2, 0.25)), 2),
+                          'description': f'/{description[:12]}', 'flags': '',
+                          'qty': None, 'remarks': None, 'tags': None, 'unitPrice': None})
+    subtotal = round(sum(line['amount'] for line in lines), 2)
+    tax = round(subtotal * 0.065, 2)
+    trip = START + datetime.timedelta(minutes=37 * n, seconds=rng.randint(0, 59))
+    return {
+        'ocr_type': 'receipts',
+        'request_id': f'P_bench_{n}',
+        'ref_no': 'ocr_python_xyz',
+        'file_name': f'r{n:07d}.jpg',
+        'request_received_on': int(trip.timestamp() * 1000),
+        'success': True,
+        'image_width': 1200,
+        'image_height': 3000,
+        'receipts': [{
+            'merchant_name': merchant,
+            'merchant_address': f'{rng.randint(100, 9999)} Main St',
+            'merchant_phone': f'(206) 555-{rng.randint(0, 9999):04d}',
+            'merchant_website': None,
+            'merchant_tax_reg_no': None,
+            'merchant_company_reg_no': None,
+            'region': None,
+            'mall': None,
+            'city': 'Seattle',
+            'state': 'WA',
+            'zip': '98101',
+            'country': 'US',
+            'receipt_no': str(n),
+            'date': trip.strftime('%Y-%m-%d'),
+            'time': trip.strftime('%H:%M:%S'),
+            'items': lines,
+            'currency': 'USD',
+            'subtotal': subtotal,
+            'tax': tax,
+            'total': round(subtotal + tax, 2),
+            'service_charge': None,
+            'tip': None,
+            'payment_method': rng.choice(('VISA', 'MASTERCARD', 'DEBIT', 'CASH')),
+            'ocr_confidence': round(rng.uniform(80, 99), 2),
+        }]
+    }
+
+def responses(n_receipts, seed=0, merchants=20, catalog_size=2000,
+              items_per_receipt=10, start=0):
+    # generates api responses for receipts start .. start + n_receipts - 1
+    rng = random.Random(seed)
+    names = [merchant_name(m) for m in range(merchants)]
+    catalogs = [catalog(rng, catalog_size) for _ in range(merchants)]
+    for n in range(start, start + n_receipts):
+        r = random.Random(f'{seed}-{n}')
+        m = min(int(r.expovariate(3 / merchants)), merchants - 1)
+        yield response(r, n, names[m], catalogs[m], items_per_receipt)
+
+def write(folder, n_receipts, seed=0, **kwargs):
+    # writes each response to folder/r<n>.json, returns the file names
+    os.makedirs(folder, exist_ok=True)
+    names = []
+    for jobj in responses(n_receipts, seed, **kwargs):
+        name = os.path.splitext(jobj['file_name'])[0] + '.json'
+        with open(os.path.join(folder, name), 'w', encoding='utf-8') as f:
+            json.dump(jobj, f)
+        names.append(name)
+    return names
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Write synthetic receipt json files')
+    parser.add_argument('receipts', type=int)
+    parser.add_argument('--out', default='json')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--merchants', type=int, default=20)
+    parser.add_argument('--catalog-size', type=int, default=2000)
+    parser.add_argument('--items-per-receipt', type=int, default=10)
+    args = parser.parse_args()
+    names = write(args.out, args.receipts, args.seed, merchants=args.merchants,
+                  catalog_size=args.catalog_size, items_per_receipt=args.items_per_receipt)
+    print(f'Wrote {len(names)} receipts to {args.out}')
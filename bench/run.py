@@ -0,0 +1,279 @@
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import bulk_load
+import database_manager as dm
+import migrations
+import ocr_api
+import reports
+import search
+import transform
+from bench import generate
+from bench.fake_ocr import FakeOCR
+
+# Runs each benchmark against databases of 1k, 100k and 1M purchases built
+# from generated receipts and saves the timings as json, see --compare
+
+SCALES = (1000, 100000, 1000000) # purchases
+RESULTS_DIR = os.path.join('bench', 'results')
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RULES = os.path.join(REPO, 'split_rules.json')
+LOAD_BATCH = 5000 # receipts per transaction while building a database
+# the creditor and debtor ids split_rules.json gives the generated purchases
+PARTICIPANTS = ((1, 'me', None), (2, 'friend', None))
+
+def summarize(seconds):
+    # latency stats in milliseconds
+    ms = sorted(s * 1000 for s in seconds)
+    pick = lambda q: ms[min(len(ms) - 1, int(q * len(ms)))]
+    return {'n': len(ms), 'mean_ms': round(sum(ms) / len(ms), 3),
+            'p50_ms': round(pick(0.5), 3), 'p95_ms': round(pick(0.95), 3),
+            'max_ms': round(ms[-1], 3)}
+
+def timed(fn, args_list):
+    seconds = []
+    for args in args_list:
+        start = perf_counter()
+        fn(*args)
+        seconds.append(perf_counter() - start)
+    return seconds
+
+def build_db(path, purchases, seed=0):
+    """
+        a migrated database with at least purchases rows loaded the way
+        bulk_load does it. Returns the number of receipts loaded
+    """
+    with sqlite3.connect(path) as con:
+        migrations.migrate(con)
+        # the report queries join purchases to them
+        con.executemany('INSERT OR IGNORE INTO participants VALUES (?, ?, ?)', PARTICIPANTS)
+    con.close()
+    dm.DB_NAME = path
+    rules = transform.load_rules(RULES)
+    n = loaded = 0
+    while loaded < purchases:
+        # about 10 items a receipt, ask for a few more than needed
+        size = min(LOAD_BATCH, (purchases - loaded) // 9 + 1)
+        with dm.transaction() as con:
+            batch = transform.transform([r['receipts'][0] for r in
+                                         generate.responses(size, seed, start=n)], rules)
+            loaded += bulk_load.load_batch(batch, con)[1]
+        n += size
+    return n
+
+def bench_upload_response(workdir, start, seed, count=50):
+    # interactive-path throughput: one file and one transaction per receipt
+    names = generate.write(os.path.join(workdir, 'json'), count, seed + 1, start=start)
+    rules = transform.load_rules(RULES)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        seconds = timed(lambda name: dm.upload_response(name, rules=rules),
+                        [(name,) for name in names])
+    finally:
+        os.chdir(cwd)
+    stats = summarize(seconds)
+    stats['receipts_per_s'] = round(len(names) / sum(seconds), 1)
+    return stats
+
+def bench_get_item_ids(con, rng, calls=200, size=10):
+    # cold skips the id caches, warm repeats the same lookups with them
+    merchants = [m for m, in con.execute('select merchant_id from merchants')]
+    lookups = []
+    for _ in range(calls):
+        merchant_id = rng.choice(merchants)
+        descriptions = [d for d, in con.execute(
+            'select description from items where merchant_id = ? order by random() limit ?',
+            (merchant_id, size))]
+        lookups.append((descriptions, merchant_id, con))
+    def cold(*args):
+        dm.clear_id_caches()
+        dm.get_item_ids(*args)
+    return {'cold': summarize(timed(cold, lookups)),
+            'warm': summarize(timed(dm.get_item_ids, lookups))}
+
+def bench_search(con, rng, calls=100):
+    # a word from a random item description, through the full-text index
+    descriptions = [d for d, in con.execute(
+        'select description from items order by random() limit ?', (calls,))]
+    words = [rng.choice(d.split()) for d in descriptions]
+    return summarize(timed(lambda w: search.search(con, w, use_cache=False),
+                           [(w,) for w in words if len(w) >= search.MIN_TERM]))
+
+def bench_generate_report(repeat=20):
+    # the latest receipt, an empty report would time a query that found nothing
+    rows = len(dm.generate_report())
+    assert rows, 'generate_report found no rows, are the participants loaded?'
+    stats = summarize(timed(dm.generate_report, [()] * repeat))
+    stats['rows'] = rows
+    return stats
+
+def bench_report_range(con, rng, calls=20):
+    # every purchase on a day with trips, through the report engine without its cache
+    days = [t[:10] for t, in con.execute(
+        'select trip_datetime from receipts order by random() limit ?', (calls,))]
+    query = lambda day: reports.query(con, use_cache=False, start=day, end=day)[1]
+    rows = [len(query(day)) for day in days]
+    assert all(rows), 'a date range report found no rows'
+    stats = summarize(timed(query, [(day,) for day in days]))
+    stats['mean_rows'] = round(sum(rows) / len(rows), 1)
+    return stats
+
+def bench_recalculate(con, rng, calls=100):
+    receipts = [r for r, in con.execute('select receipt_id from receipts')]
+    return summarize(timed(dm.recalculate_shared_payment,
+                           [(rng.choice(receipts),) for _ in range(calls)]))
+
+def bench_ocr(workdir, images=40, workers=4, latency=0.2, error_rate=0.1):
+    """
+        ocr_api.batch against the fake api. Images are random bytes, the
+        fake api doesn't look at them
+    """
+    folder = os.path.join(workdir, 'receipts')
+    os.makedirs(folder)
+    for n in range(images):
+        with open(os.path.join(folder, f'img{n}.jpg'), 'wb') as f:
+            f.write(os.urandom(50000))
+    server = FakeOCR(0, latency=latency, jitter=latency / 4, error_rate=error_rate).start()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = perf_counter()
+        status = ocr_api.batch(folder, workers=workers, per_second=0, per_day=None,
+                               api_url=server.url, skip_existing=False,
+                               state_file=None, use_cache=False)
+        seconds = perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        server.server_close()
+    return {'images': images, 'workers': workers, 'latency_s': latency,
+            'error_rate': error_rate, 'seconds': round(seconds, 3),
+            'images_per_s': round(images / seconds, 2),
+            'written': sum(1 for s in status.values() if s == 'ok'),
+            'calls': server.calls}
+
+def run_scale(purchases, seed=0):
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    rng = random.Random(seed)
+    try:
+        path = os.path.join(workdir, 'spending_tracker.db')
+        start = perf_counter()
+        receipts = build_db(path, purchases, seed)
+        result = {'build_seconds': round(perf_counter() - start, 2)}
+        con = dm.connect(path)
+        result['purchases'] = con.execute('select count(*) from purchases').fetchone()[0]
+        result['receipts'] = receipts
+        result['items'] = con.execute('select count(*) from items').fetchone()[0]
+        result['get_item_ids'] = bench_get_item_ids(con, rng)
+        result['search'] = bench_search(con, rng)
+        con.close()
+        result['upload_response'] = bench_upload_response(workdir, receipts, seed)
+        result['generate_report'] = bench_generate_report()
+        con = dm.connect(path)
+        result['report_range'] = bench_report_range(con, rng)
+        result['recalculate_shared_payment'] = bench_recalculate(con, rng)
+        con.close()
+    finally:
+        dm.DB_NAME = migrations.DB_NAME
+        dm.clear_id_caches()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    cwd=REPO, capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def run(scales=SCALES, seed=0, ocr_images=40, out=None):
+    commit, dirty = git_commit()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'seed': seed,
+        'scales': {},
+    }
+    for purchases in scales:
+        print(f'Benchmarking {purchases} purchases...', file=sys.stderr)
+        # the functions being timed print as they go
+        with contextlib.redirect_stdout(io.StringIO()):
+            results['scales'][str(purchases)] = run_scale(purchases, seed)
+    if ocr_images:
+        print(f'Benchmarking ocr of {ocr_images} images...', file=sys.stderr)
+        workdir = tempfile.mkdtemp(prefix='bench_')
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results['ocr'] = bench_ocr(workdir, ocr_images)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        out = os.path.join(RESULTS_DIR, f'{stamp}_{commit or "nogit"}.json')
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(json.dumps(results, indent=4))
+    print(f'Saved to {out}', file=sys.stderr)
+    return results
+
+def flatten(d, prefix=''):
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(flatten(v, f'{prefix}{k}.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[f'{prefix}{k}'] = v
+    return out
+
+def compare(old_path, new_path):
+    # prints every timing in both files with how much it changed
+    with open(old_path) as f:
+        old = flatten(json.load(f))
+    with open(new_path) as f:
+        new = flatten(json.load(f))
+    for key in sorted(old.keys() & new.keys()):
+        if not key.endswith(('_ms', '_per_s', 'seconds')) or not old[key]:
+            continue
+        change = new[key] / old[key] - 1
+        # for rates higher is better, for times lower is better
+        worse = change < 0 if key.endswith('_per_s') else change > 0
+        flag = ' <-' if worse and abs(change) > 0.1 else ''
+        print(f'{key:60} {old[key]:12.3f} {new[key]:12.3f} {change:+8.1%}{flag}')
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark ingest and reporting')
+    parser.add_argument('--scales', type=int, nargs='+', default=list(SCALES),
+                        help='database sizes in purchases')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ocr-images', type=int, default=40,
+                        help='images for the fake ocr api benchmark, 0 to skip')
+    parser.add_argument('--out', help=f'results file, default is under {RESULTS_DIR}')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two results files instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args.scales, args.seed, args.ocr_images, args.out)
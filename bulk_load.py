@@ -0,0 +1,323 @@
+import argparse
+import datetime
+import json
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from time import perf_counter
+
+import numpy as np
+
+import database_manager as dm
+import instrument
+import journal
+import settlement
+import transform
+
+# malformed or duplicate receipts are listed here instead of stopping the load
+REPORT_FILE = 'quarantine_report.json'
+BATCH_SIZE = 500
+# name_part1.json, name-part2.json, ... are the images of one long receipt
+PART = re.compile(r'(.+)[._-]part(\d+)', re.IGNORECASE)
+
+def find_json(folder='json'):
+    paths = []
+    for root, _, files in os.walk(folder):
+        paths += [os.path.join(root, f) for f in files if f.endswith('.json')]
+    return sorted(paths)
+
+def capture_part(path):
+    # ((name, extension), part number) for the part of a long receipt, else None
+    stem, ext = os.path.splitext(path)
+    m = PART.fullmatch(stem)
+    return ((m.group(1), ext), int(m.group(2))) if m else None
+
+def captures(paths):
+    """
+        paths grouped by capture, the parts of a long receipt together in
+        part order and every other file on its own. Groups keep the order
+        of their first file
+    """
+    groups = {}
+    for path in paths:
+        key, n = capture_part(path) or (path, 0)
+        groups.setdefault(key, []).append((n, path))
+    return [[path for _, path in sorted(group)] for group in groups.values()]
+
+def read_receipts(paths):
+    """
+        reads every file without touching the database.
+        Returns the receipts, the file each came from (the first part for a
+        long receipt), the unreadable files, path -> journal entry for every
+        file that could be read and first part -> the other parts
+    """
+    receipts, files, bad, entries, parts = [], [], [], {}, {}
+    for group in captures(paths):
+        try:
+            responses = []
+            for path in group:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                entries[path] = journal.entry(path, data)
+                responses.append(json.loads(data))
+            found = transform.response_receipts(responses)
+        except (OSError, ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            bad += [{'file': path, 'error': f'{type(e).__name__}: {e}'} for path in group]
+            continue
+        receipts += found
+        files += [group[0]] * len(found)
+        if len(group) > 1:
+            parts[group[0]] = group[1:]
+    return receipts, files, bad, entries, parts
+
+def load_batch(batch, con):
+    """
+        writes the rows transform.transform made for a batch of receipts
+        with one executemany per table. Returns (receipts, purchases) loaded
+    """
+    trips, items = batch['trips'], batch['items']
+    if not trips:
+        return 0, 0
+
+    # merchants
+    merchant_ids = dict(zip([m['ocr_name'] for m in batch['merchants']],
+                            dm.insert_to_merchants(batch['merchants'], con)))
+    trip_merchant = np.array([merchant_ids[t[0]] for t in trips], dtype=np.int64)
+    item_merchant = trip_merchant[items['trip']].tolist()
+
+    # items
+    descriptions = {}
+    for merchant_id, d in zip(item_merchant, items['description']):
+        descriptions.setdefault(merchant_id, set()).add(d)
+    item_ids = {}
+    for merchant_id, merchant_descriptions in descriptions.items():
+        found = dm.get_or_create_item_ids(list(merchant_descriptions), merchant_id, con)
+        item_ids.update({(merchant_id, d):i for d, i in found.items()})
+
+    # receipts
+    now = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
+    trip_ids = dm.insert_to_receipts(
+        [(None, merchant_id, trip_dt, now, subtotal, tax, total)
+         for merchant_id, (_, trip_dt, subtotal, tax, total)
+         in zip(trip_merchant.tolist(), trips)], con)
+    item_trip = np.array(trip_ids, dtype=np.int64)[items['trip']].tolist()
+
+    # purchases
+    purchases = list(zip(
+        repeat(None),
+        item_trip,
+        item_merchant,
+        [item_ids.get(k) for k in zip(item_merchant, items['description'])],
+        items['item_cost'].tolist(),
+        items['discount'].tolist(),
+        items['quantity'],
+        items['unit_price'],
+        items['flag'],
+        items['notes'],
+        items['creditor'].tolist(),
+        items['debtor'].tolist(),
+        items['debt_multiplier'].tolist(),
+    ))
+    dm.insert_to_purchases(purchases, con)
+    # one set-based pass over every receipt in the batch
+    settlement.recalculate(con)
+    return len(trips), len(purchases)
+
+def receipt_ids(trips, con):
+    # trip_datetime -> receipt_id for the trips already in the database
+    placeholders = ','.join(['?'] * len(trips))
+    sql = f'select trip_datetime, receipt_id from receipts where trip_datetime in ({placeholders})'
+    return dict(con.execute(sql, trips))
+
+def parse_files(paths, rules):
+    """
+        reads, hashes and transforms a chunk of files without touching the
+        database, so it can run in a worker process. Returns the batch,
+        the file each of its trips came from, the files that couldn't be
+        used, path -> journal entry and the parts of long receipts, all ready
+        for write_parsed
+    """
+    start = perf_counter()
+    with instrument.span('load.read_files'):
+        receipts, files, bad, entries, parts = read_receipts(paths)
+    with instrument.span('load.transform'):
+        batch = transform.transform(receipts, rules)
+    bad += [{'file': files[n], 'error': e} for n, e in batch['bad']]
+    return {'batch': batch, 'files': [files[n] for n in batch['good']], 'bad': bad,
+            'entries': entries, 'parts': parts, 'seconds': perf_counter() - start}
+
+def drop_duplicate_trips(batch, files, is_new, con):
+    # the check_duplicate_trip_datetime trigger would abort the whole insert
+    trips = [t[1] for t in batch['trips']]
+    seen = set(receipt_ids(trips, con))
+    keep, duplicates = [], []
+    for path, trip in zip(files, trips):
+        if is_new(path) and trip in seen:
+            duplicates.append({'file': path, 'error': f"Duplicate trip_datetime {trip}",
+                               'trip': trip})
+        elif is_new(path):
+            seen.add(trip)
+            keep.append(True)
+            continue
+        keep.append(False)
+    return (transform.subset(batch, keep), [f for f, k in zip(files, keep) if k],
+            duplicates)
+
+def journal_rows(files, parts, entries, batch, duplicates, bad, con):
+    # what happened to each file of a batch, for the ingest journal. A file
+    # with several receipts gets one row, loaded if any of them was
+    trips = [t[1] for t in batch['trips']]
+    trip_ids = receipt_ids(trips + [d['trip'] for d in duplicates], con)
+    results = [(path, 'loaded', trip_ids[trip], None) for path, trip in zip(files, trips)]
+    results += [(d['file'], 'duplicate', trip_ids.get(d['trip']), d['error'])
+                for d in duplicates]
+    results += [(b['file'], 'quarantined', None, b['error']) for b in bad]
+    rows = {}
+    for path, status, receipt_id, error in results:
+        for p in [path] + parts.get(path, []):
+            if p in entries and p not in rows:
+                rows[p] = dict(entries[p], status=status, receipt_id=receipt_id, error=error)
+    return list(rows.values())
+
+def write_parsed(parsed, con, retry_quarantined=False):
+    """
+        the database half of a load, from what parse_files returned. Skips
+        content already journaled, drops duplicate trips, writes the rest and
+        journals every file, all in the caller's transaction.
+        Returns (receipts loaded, purchases loaded, files skipped, quarantined)
+    """
+    entries, parts = parsed['entries'], parsed['parts']
+    with instrument.span('load.journal'):
+        # content already journaled under any name
+        found = journal.known(con, [e['file_hash'] for e in entries.values()],
+                              retry_quarantined)
+    # a long receipt is new when any of its parts is
+    is_new = lambda path: any(entries.get(p, {}).get('file_hash') not in found
+                              for p in [path] + parts.get(path, []))
+    bad = [b for b in parsed['bad'] if is_new(b['file'])]
+    skipped = {b['file'] for b in parsed['bad'] if not is_new(b['file'])}
+    skipped.update(p for path in parsed['files'] if not is_new(path)
+                   for p in [path] + parts.get(path, []))
+    with instrument.span('load.drop_duplicates'):
+        batch, files, duplicates = drop_duplicate_trips(parsed['batch'], parsed['files'],
+                                                        is_new, con)
+    with instrument.span('load.write_batch'):
+        loaded, purchases = load_batch(batch, con)
+    with instrument.span('load.journal'):
+        journal.record(con, journal_rows(files, parts, entries, batch, duplicates, bad, con))
+    return loaded, purchases, len(skipped), bad + duplicates
+
+_rules = None # split rules of a worker process
+
+def _init_worker(rules_path):
+    global _rules
+    _rules = transform.load_rules(rules_path)
+
+def _parse_chunk(paths):
+    return parse_files(paths, _rules)
+
+def parsed_chunks(chunks, rules_path, processes=1):
+    """
+        parse_files for each chunk of paths, in order. With more than one
+        process the chunks are parsed in a process pool, at most two per
+        process ahead of the writer so memory stays bounded
+    """
+    if processes <= 1:
+        rules = transform.load_rules(rules_path)
+        for chunk in chunks:
+            yield parse_files(chunk, rules)
+        return
+    with ProcessPoolExecutor(processes, initializer=_init_worker,
+                             initargs=(rules_path,)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_parse_chunk, chunk))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def bulk_load(folder='json', rules_path='split_rules.json', batch_size=BATCH_SIZE,
+              report_path=REPORT_FILE, retry_quarantined=False, processes=1):
+    """
+        loads every json file under folder without asking anything.
+        Every receipt in a file is loaded, and the parts of a long receipt
+        (name_part1.json, name_part2.json, ...) are stitched into one.
+        Files are parsed and transformed in processes worker processes and
+        this process is the only writer, committing each batch in one
+        transaction together with its journal rows. Files already in the
+        journal are skipped
+    """
+    start = perf_counter()
+    processes = processes or os.cpu_count() or 1
+    paths = find_json(folder)
+    # unchanged files cost a stat, renamed or touched ones a read
+    with instrument.span('load.journal'), dm.transaction() as con:
+        done = journal.unchanged(con, paths, retry_quarantined)
+    # a long receipt is read again whole when any part changed, and its
+    # parts always go in the same chunk
+    chunks = []
+    for group in captures(paths):
+        if all(p in done for p in group):
+            continue
+        if not chunks or len(chunks[-1]) >= batch_size:
+            chunks.append([])
+        chunks[-1] += group
+
+    quarantined = []
+    n_receipts = n_purchases = n_parsed = 0
+    n_skipped = len(paths) - sum(map(len, chunks))
+    parse_seconds = write_seconds = 0.0
+    for parsed in parsed_chunks(chunks, rules_path, processes):
+        parse_seconds += parsed['seconds']
+        n_parsed += len(parsed['batch']['items']['trip'])
+        write_start = perf_counter()
+        with dm.transaction() as con:
+            loaded, purchases, skipped, bad = write_parsed(parsed, con, retry_quarantined)
+        write_seconds += perf_counter() - write_start
+        n_receipts += loaded
+        n_purchases += purchases
+        n_skipped += skipped
+        quarantined += bad
+    elapsed = perf_counter() - start
+
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(quarantined, f, indent=4)
+    print(f'{len(paths)} files, {n_receipts} receipts and {n_purchases} purchases '
+          f'loaded, {n_skipped} skipped as already journaled, {len(quarantined)} quarantined '
+          f'(see {report_path})')
+    print(f'{elapsed:.2f}s, {n_receipts / elapsed:.1f} receipts/s, '
+          f'{n_purchases / elapsed:.1f} purchases/s')
+    if chunks:
+        # parse time is summed over the workers, the writer is one thread
+        print(f'parse: {n_parsed} rows in {parse_seconds:.2f}s over {processes} '
+              f'process(es), {n_parsed / parse_seconds:.1f} rows/s per process')
+        print(f'write: {n_purchases} rows in {write_seconds:.2f}s, '
+              f'{n_purchases / write_seconds:.1f} rows/s, idle '
+              f'{elapsed - write_seconds:.2f}s waiting for parsed batches')
+    print(f'id cache: {dm.id_cache_stats()}')
+    return {'files': len(paths), 'receipts': n_receipts, 'purchases': n_purchases,
+            'skipped': n_skipped, 'quarantined': len(quarantined), 'seconds': elapsed,
+            'processes': processes, 'parse_seconds': parse_seconds,
+            'write_seconds': write_seconds}
+
+def add_arguments(parser):
+    parser.add_argument('folder', nargs='?', default='json')
+    parser.add_argument('--rules', default='split_rules.json')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--report', default=REPORT_FILE)
+    parser.add_argument('--retry', action='store_true',
+                        help='try quarantined files again even if they did not change')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='parse in this many worker processes, 0 for one per core')
+
+def run(args):
+    bulk_load(args.folder, args.rules, args.batch_size, args.report, args.retry,
+              args.processes)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load a folder of OCR json files without prompts')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,170 @@
+import json
+import os
+import re
+from itertools import product
+from time import perf_counter
+
+import instrument
+from migrations import DB_NAME
+
+# Puts every item in a spending category (produce, snacks, ...) using the
+# rules in category_rules.json. All the keywords go into one dict lookup per
+# word and all the patterns into one compiled regex, so an item costs a pass
+# over its words and at most one regex scan however many rules there are.
+# Items are unique per (merchant_id, description), so items.category is the
+# cache: new items get a category as they are loaded (categorize_new) and
+# the whole catalog is only run again when the rules change:
+#   python categorize.py --all
+
+RULES_FILE = 'category_rules.json'
+DEFAULT_CATEGORY = 'other'
+WORD = re.compile(r'[A-Z0-9]+')
+
+def _forms(word):
+    # BANANA and BANANAS are the same keyword
+    if len(word) > 3 and word.endswith('S'):
+        return (word, word[:-1])
+    return (word, word + 'S')
+
+class Matcher:
+    """
+        compiled category rules, from a json dict with
+          default: category for items no rule matches
+          rules: [{category, keywords: [...], patterns: [...]}]
+        Keywords match whole words or runs of words, patterns are regexes
+        searched without case. When several rules match, the first one in
+        the file wins
+    """
+    def __init__(self, rules):
+        self.default = rules.get('default', DEFAULT_CATEGORY)
+        self.categories = [r['category'] for r in rules['rules']]
+        self.words = {} # word -> rule number
+        self.phrases = {} # tuple of words -> rule number
+        self.longest = 1
+        self.groups = {} # regex group name -> rule number
+        patterns = []
+        for n, rule in enumerate(rules['rules']):
+            for keyword in rule.get('keywords', ()):
+                words = WORD.findall(keyword.upper())
+                for form in product(*map(_forms, words)):
+                    if len(form) == 1:
+                        self.words.setdefault(form[0], n)
+                    else:
+                        self.phrases.setdefault(form, n)
+                self.longest = max(self.longest, len(words))
+            for pattern in rule.get('patterns', ()):
+                name = f'r{len(patterns)}'
+                # a lookahead matches nothing, so every rule is tried at every
+                # start even where an earlier match would have consumed it
+                patterns.append(f'(?=(?P<{name}>{pattern}))')
+                self.groups[name] = n
+        self.pattern = re.compile('|'.join(patterns), re.IGNORECASE) if patterns else None
+        # a keyword hit on a rule before this one can't be beaten by a pattern
+        self.first_pattern = min(self.groups.values(), default=len(self.categories))
+        self.cache = {}
+
+    def match(self, text):
+        words = WORD.findall(text.upper())
+        best = len(self.categories)
+        get = self.words.get
+        for word in words:
+            n = get(word, best)
+            if n < best:
+                best = n
+        for size in range(2, min(self.longest, len(words)) + 1):
+            for i in range(len(words) - size + 1):
+                best = min(best, self.phrases.get(tuple(words[i:i + size]), best))
+        if self.pattern is not None and best > self.first_pattern:
+            # the alternation takes the first rule matching at each start
+            for m in self.pattern.finditer(text):
+                best = min(best, self.groups[m.lastgroup])
+                if best == self.first_pattern:
+                    break
+        return self.categories[best] if best < len(self.categories) else self.default
+
+    def classify(self, description, user_descr=None):
+        # the category of an item, the same description is only matched once
+        text = f'{description or ""} {user_descr or ""}'
+        category = self.cache.get(text)
+        if category is None:
+            category = self.cache[text] = self.match(text)
+        return category
+
+_matchers = {} # path -> (mtime, Matcher)
+
+def load(path=RULES_FILE):
+    # the Matcher for a rules file, compiled again only when the file changes
+    mtime = os.stat(path).st_mtime_ns
+    cached = _matchers.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            cached = _matchers[path] = (mtime, Matcher(json.load(f)))
+    return cached[1]
+
+def categorize_new(con, matcher=None):
+    """
+        fills in the category of items that don't have one yet, in the
+        caller's transaction. Without a matcher the rules come from
+        RULES_FILE, and without that file nothing happens, the items are
+        picked up by the next run that has rules. Returns how many
+    """
+    if matcher is None:
+        try:
+            matcher = load()
+        except FileNotFoundError:
+            return 0
+    with instrument.span('categorize.new'):
+        rows = con.execute("""
+            select item_id, description, user_descr
+            from items
+            where category is null
+        """).fetchall()
+        con.executemany('update items set category = ? where item_id = ?',
+                        [(matcher.classify(d, u), item_id) for item_id, d, u in rows])
+    return len(rows)
+
+def recategorize(con, matcher):
+    """
+        runs the rules over the whole catalog again and writes the categories
+        that changed, in the caller's transaction. Returns (items, changed)
+    """
+    with instrument.span('categorize.all'):
+        rows = con.execute('select item_id, description, user_descr, category from items')
+        changed = []
+        n = 0
+        for item_id, description, user_descr, old in rows:
+            category = matcher.classify(description, user_descr)
+            if category != old:
+                changed.append((category, item_id))
+            n += 1
+        con.executemany('update items set category = ? where item_id = ?', changed)
+    return n, len(changed)
+
+def add_arguments(parser):
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--rules', default=RULES_FILE)
+    parser.add_argument('--all', action='store_true',
+                        help='categorize every item again, after changing the rules')
+    parser.add_argument('--test', metavar='DESCRIPTION',
+                        help='print the category of a description and stop')
+
+def run(args):
+    matcher = load(args.rules)
+    if args.test:
+        print(matcher.classify(args.test))
+        return
+    start = perf_counter()
+    con = instrument.connect(args.db)
+    with con:
+        if args.all:
+            n, changed = recategorize(con, matcher)
+        else:
+            n = changed = categorize_new(con, matcher)
+    con.close()
+    print(f'Categorized {n} items, {changed} changed, in {perf_counter() - start:.2f}s')
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Sort items into spending categories')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,121 @@
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+
+import instrument
+
+# One entry point for the scripts: python cli.py <command> ...
+# Only the module behind the command being run gets imported, so short
+# commands like report or settle never load pandas, numpy or requests
+
+# command -> (module with add_arguments and run, help)
+COMMANDS = {
+    'ocr': ('ocr_api', 'OCR receipt images into the json folder'),
+    'load': ('bulk_load', 'load a folder of OCR json files without prompts'),
+    'report': ('reports', 'report on purchases'),
+    'search': ('search', 'search purchases by item description'),
+    'categorize': ('categorize', 'sort items into spending categories'),
+    'prices': ('prices', 'item prices over time and the ones that moved'),
+    'settle': ('settlement', 'work out who owes whom'),
+    'migrate': ('migrations', 'create or upgrade the database schema'),
+    'snapshot': ('snapshot', 'export purchases as columnar files by month'),
+    'watch': ('watch', 'OCR and load new receipt images as they arrive'),
+    'dedup': ('dedup', 'find photos of the same receipt'),
+}
+
+# command -> (seconds allowed to import it, modules it must not import)
+IMPORT_BUDGETS = {
+    'ocr': (0.5, ('pandas', 'numpy')),
+    'load': (0.5, ('pandas', 'requests')),
+    'report': (0.1, ('pandas', 'numpy', 'requests')),
+    'search': (0.1, ('pandas', 'numpy', 'requests')),
+    'categorize': (0.1, ('pandas', 'numpy', 'requests')),
+    'prices': (0.1, ('pandas', 'numpy', 'requests')),
+    'settle': (0.1, ('pandas', 'numpy', 'requests')),
+    'migrate': (0.1, ('pandas', 'numpy', 'requests')),
+    'snapshot': (0.1, ('pandas', 'numpy', 'requests', 'pyarrow')),
+    'watch': (0.5, ('pandas',)),
+    'dedup': (0.1, ('pandas', 'numpy', 'requests')),
+}
+
+IMPORT_CHECK = """
+import sys
+from time import perf_counter
+start = perf_counter()
+import {module}
+print(perf_counter() - start)
+print(' '.join(sys.modules))
+"""
+
+def import_time(command):
+    """
+        imports the module behind a command in a fresh interpreter.
+        Returns (seconds, names of every module loaded)
+    """
+    module = COMMANDS[command][0]
+    out = subprocess.run([sys.executable, '-c', IMPORT_CHECK.format(module=module)],
+                         capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split('\n')
+    return float(out[0]), set(out[1].split())
+
+def check_startup(repeat=3):
+    # best of a few runs per command, returns the number of commands over budget
+    failed = 0
+    for command, (budget, forbidden) in IMPORT_BUDGETS.items():
+        runs = [import_time(command) for _ in range(repeat)]
+        seconds = min(t for t, _ in runs)
+        loaded = sorted(m for m in forbidden if m in runs[0][1])
+        ok = seconds <= budget and not loaded
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {command:10} {seconds * 1000:6.1f}ms "
+              f"(budget {budget * 1000:.0f}ms)"
+              + (f" imports {', '.join(loaded)}" if loaded else ''))
+    return failed
+
+def make_parser(command=None):
+    """
+        the parser with a subcommand per entry in COMMANDS. Only command's
+        module is imported to add its arguments, the others take anything
+    """
+    parser = argparse.ArgumentParser(description='Spending tracker')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='time each stage and write a summary, .prom for prometheus')
+    parser.add_argument('--trace-sql', action='store_true',
+                        help='with --profile, also time every sql statement')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name, (module, help) in COMMANDS.items():
+        sub = commands.add_parser(name, help=help, description=help,
+                                  add_help=name == command)
+        if name == command:
+            module = importlib.import_module(module)
+            module.add_arguments(sub)
+            sub.set_defaults(run=module.run)
+    sub = commands.add_parser('check-startup',
+                              help='fail if a command imports too much or too slowly')
+    sub.add_argument('--repeat', type=int, default=3)
+    return parser
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # argparse finds the subcommand first, so a flag's value that happens to
+    # be a command name isn't taken for it
+    command = make_parser().parse_known_args(argv)[0].command
+    args = make_parser(command).parse_args(argv)
+    if args.command == 'check-startup':
+        if check_startup(args.repeat):
+            raise SystemExit(1)
+        return
+    if args.profile:
+        instrument.enable(sql=args.trace_sql)
+    try:
+        args.run(args)
+    finally:
+        if args.profile:
+            instrument.write(args.profile)
+            instrument.print_summary()
+            print(f'Profile written to {args.profile}')
+
+if __name__ == "__main__":
+    main()
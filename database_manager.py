@@ -1,27 +1,188 @@
 import json
 import datetime
-import pandas as pd
+import os
+import re
 import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import repeat
 
-import ocr_api
+# pandas and ocr_api (requests) are imported inside the functions that use
+# them so loading json or running reports doesn't pay for them at startup
+import categorize
+import instrument
+import journal
+import reports
+import settlement
+from transform import response_receipts, transform
 
 DB_NAME = "spending_tracker.db"
 
-def items_to_df():
-    with sqlite3.connect(DB_NAME) as con:
+# WAL lets reports read while a load is writing and NORMAL sync only
+# fsyncs at checkpoints instead of on every commit
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -20000', # about 20MB
+    'PRAGMA busy_timeout = 5000',
+)
+
+class IdCache:
+    """
+        bounded LRU map used to skip repeat id lookups during a load.
+        Entries added inside a transaction stay pending until it commits
+        and are dropped again if it rolls back
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.pending = {} # id(con) -> keys added in that open transaction
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, con):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        self.pending.setdefault(id(con), []).append(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def commit(self, con):
+        self.pending.pop(id(con), None)
+
+    def rollback(self, con):
+        for key in self.pending.pop(id(con), []):
+            self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+        self.pending.clear()
+
+    def stats(self):
+        return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
+# ocr_name -> merchant_id and (merchant_id, description) -> item_id
+merchant_cache = IdCache(1000)
+item_cache = IdCache(100000)
+_cached_db = None
+
+class Connection(sqlite3.Connection):
+    """
+        what connect() returns. The ids cached in a transaction are kept when
+        it commits and dropped when it rolls back or the connection closes
+        with it still open, also when the caller owns the transaction
+    """
+    def commit(self):
+        super().commit()
+        merchant_cache.commit(self)
+        item_cache.commit(self)
+
+    def rollback(self):
+        super().rollback()
+        self._forget()
+
+    def __exit__(self, exc_type, exc, tb):
+        # sqlite3 commits or rolls back `with con:` without calling the methods
+        result = super().__exit__(exc_type, exc, tb)
+        if exc_type is None:
+            merchant_cache.commit(self)
+            item_cache.commit(self)
+        else:
+            self._forget()
+        return result
+
+    def close(self):
+        super().close() # discards an open transaction
+        self._forget()
+
+    def _forget(self):
+        merchant_cache.rollback(self)
+        item_cache.rollback(self)
+
+class _TracedConnection(Connection, instrument.Connection):
+    pass
+
+def clear_id_caches():
+    merchant_cache.clear()
+    item_cache.clear()
+
+def id_cache_stats():
+    return {'merchants': merchant_cache.stats(), 'items': item_cache.stats()}
+
+def connect(db_name=None):
+    global _cached_db
+    db_name = db_name or DB_NAME
+    if db_name != _cached_db:
+        # ids from another database mean nothing here
+        clear_id_caches()
+        _cached_db = db_name
+    # instrument.connect's tracing, with the id cache hooks on top
+    factory = _TracedConnection if instrument.sql_enabled else Connection
+    con = sqlite3.connect(db_name, factory=factory)
+    for pragma in PRAGMAS:
+        con.execute(pragma)
+    return con
+
+@contextmanager
+def transaction(con=None):
+    """
+        unit of work shared by the insert and lookup functions.
+        Without con a new connection is opened and everything done inside the
+        with block is committed once at the end, or rolled back on error.
+        With con the caller owns the transaction and nothing is committed
+        here. Either way the id caches follow the commit or rollback, as long
+        as con came from connect()
+    """
+    if con is not None:
+        yield con
+        return
+    con = connect()
+    try:
+        yield con
+        with instrument.span('db.commit'):
+            con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+
+def _records(rows, insert):
+    """
+        the statement and parameters for executemany. Dataframes and dicts
+        use the named parameters, tuples fill them in table column order
+    """
+    if hasattr(rows, 'to_dict'): # a dataframe, without importing pandas
+        return insert, rows.to_dict(orient='records')
+    if not isinstance(rows, (list, tuple)):
+        raise ValueError('1st argument must be pandas dataframe or a list of rows!!')
+    if rows and not isinstance(rows[0], dict):
+        return re.sub(r':(\w+)', '?', insert), rows
+    return insert, rows
+
+def items_to_df(con=None):
+    import pandas as pd
+    with transaction(con) as con:
         sql = 'select * from items'
         df = pd.read_sql(sql=sql, con=con)
     return df
 
-def insert_to_merchants(df):
-    if not isinstance(df, pd.DataFrame):
-        raise ValueError('1st argument must be pandas dataframe!!')
-    print('opening connection to merchants')
-    with sqlite3.connect(DB_NAME) as con:
+def insert_to_merchants(df, con=None):
+    with instrument.span('db.insert_to_merchants'), transaction(con) as con:
         cur = con.cursor()
-        data = df.to_dict(orient='records')
         insert = """
-                INSERT OR IGNORE INTO merchants 
+                INSERT INTO merchants 
                 VALUES(
                         :merchant_id, 
                         :ocr_name,
@@ -33,37 +194,47 @@ def insert_to_merchants(df):
                         :state,
                         :zip,
                         :country
-                )"""
-        cur.executemany(insert, data)
-        con.commit()
+                )
+                ON CONFLICT DO NOTHING
+                RETURNING merchant_id"""
+        insert, data = _records(df, insert)
+        # returns the merchant_id of every row, new or already there
+        ids = []
+        for row in data:
+            ocr_name = row['ocr_name'] if isinstance(row, dict) else row[1]
+            merchant_id = merchant_cache.get(ocr_name)
+            if merchant_id is None:
+                cur.execute(insert, row)
+                new = cur.fetchone()
+                if new is None:
+                    merchant_id = get_merchant_id(ocr_name, con)
+                else:
+                    merchant_id = new[0]
+                    merchant_cache.put(ocr_name, merchant_id, con)
+            ids.append(merchant_id)
     print('exiting insert_to_merchants')
+    return ids
 
-def insert_to_items(df):
-    if not isinstance(df, pd.DataFrame):
-        raise ValueError('1st argument must be pandas dataframe!!')
-    print('opening connection to items')
-    with sqlite3.connect(DB_NAME) as con:
+def insert_to_items(df, con=None):
+    with instrument.span('db.insert_to_items'), transaction(con) as con:
         cur = con.cursor()
-        data = df.to_dict(orient='records')
+        # items_merchant_description (see create_db.py) skips known items
         insert = """
-                INSERT OR IGNORE INTO items 
+                INSERT INTO items (item_id, merchant_id, description, user_descr)
                 VALUES(
                         :item_id, 
                         :merchant_id,
                         :description,
                         :user_descr
-                )"""
+                )
+                ON CONFLICT (merchant_id, description) DO NOTHING"""
+        insert, data = _records(df, insert)
         cur.executemany(insert, data)
-        con.commit()
     print('exiting insert_to_items')
 
-def insert_to_receipts(df):
-    if not isinstance(df, pd.DataFrame):
-        raise ValueError('1st argument must be pandas dataframe!!')
-    print('opening connection to receipts')
-    with sqlite3.connect(DB_NAME) as con:
+def insert_to_receipts(df, con=None):
+    with instrument.span('db.insert_to_receipts'), transaction(con) as con:
         cur = con.cursor()
-        data = df.to_dict(orient='records')
         insert = """
                 INSERT OR ABORT INTO receipts 
                 VALUES(
@@ -74,18 +245,19 @@ def insert_to_receipts(df):
                         :subtotal,
                         :tax,
                         :total
-                )"""
-        cur.executemany(insert, data)
-        con.commit()
+                )
+                RETURNING receipt_id"""
+        insert, data = _records(df, insert)
+        ids = []
+        for row in data:
+            cur.execute(insert, row)
+            ids.append(cur.fetchone()[0])
     print('exiting insert_to_receipts')
+    return ids
 
-def insert_to_purchases(df):
-    if not isinstance(df, pd.DataFrame):
-        raise ValueError('1st argument must be pandas dataframe!!')
-    print('opening connection to purchases')
-    with sqlite3.connect(DB_NAME) as con:
+def insert_to_purchases(df, con=None):
+    with instrument.span('db.insert_to_purchases'), transaction(con) as con:
         cur = con.cursor()
-        data = df.to_dict(orient='records')
         insert = """
                 INSERT OR IGNORE INTO purchases 
                 VALUES
@@ -104,19 +276,17 @@ def insert_to_purchases(df):
                     :debtor,
                     :debt_multiplier 
                 )"""
+        insert, data = _records(df, insert)
         cur.executemany(insert, data)
-        con.commit()
     print('exiting insert_to_purchases')
 
-def insert_to_shared_payments(df):
-    if not isinstance(df, pd.DataFrame):
-        raise ValueError('1st argument must be pandas dataframe!!')
-    print('opening connection to shared_payments')
-    with sqlite3.connect(DB_NAME) as con:
+def insert_to_shared_payments(df, con=None):
+    with instrument.span('db.insert_to_shared_payments'), transaction(con) as con:
         cur = con.cursor()
-        data = df.to_dict(orient='records')
         insert = """
                 INSERT OR IGNORE INTO shared_payments 
+                (shared_payment_id, receipt_id, creditor, debtor,
+                 amount_owed, is_paid, paid_datetime)
                 VALUES(
                 :shared_payment_id,
                 :receipt_id,
@@ -126,12 +296,15 @@ def insert_to_shared_payments(df):
                 :is_paid,
                 :paid_datetime 
                 )"""
+        insert, data = _records(df, insert)
         cur.executemany(insert, data)
-        con.commit()
     print('exiting insert_to_shared_payments')
 
-def get_merchant_id(ocr_name):
-    with sqlite3.connect(DB_NAME) as con:
+def get_merchant_id(ocr_name, con=None):
+    merchant_id = merchant_cache.get(ocr_name)
+    if merchant_id is not None:
+        return merchant_id
+    with transaction(con) as con:
         params = {'ocr_name':ocr_name}
         cur = con.cursor()
         sql = """
@@ -144,10 +317,11 @@ def get_merchant_id(ocr_name):
         """
         cur.execute(sql, params)
         result = cur.fetchall()
+        merchant_cache.put(ocr_name, result[0][0], con)
     return result[0][0]
 
-def get_trip_id(trip_datetime):
-    with sqlite3.connect(DB_NAME) as con:
+def get_trip_id(trip_datetime, con=None):
+    with transaction(con) as con:
         params = {'trip_datetime':trip_datetime}
         cur = con.cursor()
         sql = """
@@ -162,10 +336,21 @@ def get_trip_id(trip_datetime):
         result = cur.fetchall()
     return result[0][0]
 
-def get_item_ids(descriptions, merchant_id):
+def get_item_ids(descriptions, merchant_id, con=None):
     # descriptions should be a list
     # use the descriptions and merchant_id to get itemids for the trip
-    with sqlite3.connect(DB_NAME) as con:
+    description_to_id = {}
+    missing = []
+    for d in set(descriptions):
+        item_id = item_cache.get((merchant_id, d))
+        if item_id is None:
+            missing.append(d)
+        else:
+            description_to_id[d] = item_id
+    if not missing:
+        return description_to_id
+    descriptions = missing
+    with instrument.span('db.get_item_ids'), transaction(con) as con:
         cur = con.cursor()
         placeholders = ','.join(['?'] * len(descriptions))
         sql = f'''
@@ -178,266 +363,301 @@ def get_item_ids(descriptions, merchant_id):
         '''
         params = descriptions + [merchant_id]
         cur.execute(sql, params)
-        description_to_id = {}
         for row in cur.fetchall():
             description_to_id[row[0]] = row[1]
+            item_cache.put((merchant_id, row[0]), row[1], con)
     return description_to_id
 
-def remove_existing_records(dataframe):
-    with sqlite3.connect(DB_NAME) as con:
-        sql = "SELECT description, merchant_id FROM items"
-        existing_data = pd.read_sql_query(sql, con)
-    merged_data = dataframe.merge(existing_data, 
-                                  on=['description', 'merchant_id'], 
-                                  how='left', 
-                                  indicator=True)
-    new_data = merged_data[merged_data['_merge'] == 'left_only']    
-    new_data = new_data.drop(columns=['_merge'])
-    return new_data.drop_duplicates()
-
-def upload_response(filename):
-    with open(f"json/{filename}") as f_in:
-        jobj = json.load(f_in)
-    receipt = jobj['receipts'][0]
-
-    # list the merchant details
-    merchant = {
-        'merchant_id':None,
-        'ocr_name': receipt['merchant_name'],
-        'address': receipt['merchant_address'], 
-        'name':None,
-        'phone': receipt['merchant_phone'],
-        'website': receipt['merchant_website'],
-        'city':receipt['city'],
-        'state':receipt['state'],
-        'zip':receipt['zip'],
-        'country': receipt['country']
-    }
-    merchant_df = pd.DataFrame(merchant, index=[0])
-    # load merchant to db if not already there
-    insert_to_merchants(merchant_df)
-
-    # load the items into a dataframe if not already there
-    items = pd.DataFrame(receipt['items'])
-    items.rename(columns={
-                    'amount':'item_cost',
-                    'qty':'quantity', 
-                    'unitPrice':'unit_price', 
-                    'flags':'flag', 
-                    'remarks':'notes'},
-                inplace=True)
-
-    items['discount']=0 # creates a new column for discounts
-    # loops through the discounts and adds it to the row above
-    discount_list = items[items['item_cost'] < 0].index
-    if len(discount_list) != 0:
-        for i in discount_list: 
-            items.loc[i-1, 'discount'] = items.loc[i, 'item_cost']
-        dis_del = discount_list.append(discount_list-1) # get indexes of discounts
-        dis_del = dis_del.sort_values() # sort them
-
-        print(items.loc[dis_del])
-        if input('Do you approve deleting the discount row and writing the \
-                 item_cost to the discount value in the previous row? y/n\n')!='y':
-            raise ValueError('Not approved. Exiting!!')
+def get_or_create_item_ids(descriptions, merchant_id, con=None):
+    """
+        adds any descriptions the merchant doesn't have yet and returns
+        description -> item_id for all of them.
+        Both steps use the (merchant_id, description) index so the cost
+        doesn't grow with the size of the items table
+    """
+    merchant_id = int(merchant_id)
+    with transaction(con) as con:
+        known = get_item_ids(list(descriptions), merchant_id, con)
+        new = [(merchant_id, d) for d in set(descriptions) if d not in known]
+        if not new:
+            return known
+        con.executemany("""
+            INSERT INTO items (merchant_id, description)
+            VALUES (?, ?)
+            ON CONFLICT (merchant_id, description) DO NOTHING
+        """, new)
+        known.update(get_item_ids([d for _, d in new], merchant_id, con))
+        # only the items just added get matched against the category rules
+        categorize.categorize_new(con)
+        return known
 
-        # remove the row(s)
-        # if else because the drop function doesn't like a list with 1 value
-        if len(discount_list)==1:
-            items.drop(discount_list[0], inplace=True)
-        else:
-            items.drop(discount_list, inplace=True)
-        items.reset_index(drop=True, inplace=True)
+def remove_existing_records(dataframe, con=None):
+    # keeps the (description, merchant_id) rows that aren't in items yet
+    existing = set()
+    with transaction(con) as con:
+        for merchant_id, group in dataframe.groupby('merchant_id'):
+            found = get_item_ids(group['description'].to_list(), int(merchant_id), con)
+            existing.update((int(merchant_id), d) for d in found)
+    is_new = [(m, d) not in existing
+              for m, d in zip(dataframe['merchant_id'], dataframe['description'])]
+    return dataframe[is_new].drop_duplicates()
 
-    # make the dataframe for the items table
-    items_df = pd.DataFrame(items['description'])
-    merchant_id = get_merchant_id(merchant['ocr_name'])
-    try:
-        items_df['merchant_id'] = merchant_id
-    except ValueError:
-        breakpoint()
-    items_df = remove_existing_records(items_df)
-    if len(items_df) > 0:
-        items_df['item_id'] = None
-        items_df['user_descr'] = None
-        insert_to_items(items_df)    
-
-    # make the dataframe for the receipts table
-    # read the datetime from the receipt
-    date_dict = {
-        'date': receipt['date'],
-        'time': receipt['time']
-    }
+def upload_response(filename, con=None, rules=None):
+    """
+        loads every receipt in one json file from the json folder. It all
+        commits in a single transaction, or in the caller's when con is given.
+        With rules (see transform.load_rules) nothing is asked on the terminal.
+        shared_payments are worked out by settlement.recalculate.
+        A file already in the ingest journal is skipped.
+        Returns the receipt_ids
+    """
+    return _upload_capture([f"json/{filename}"], con, rules)
 
-    try:
-        trip_dt = date_dict['date'] + ' ' + date_dict['time']
-    except TypeError:
-        print('Error with date or time from receipt!')
-        breakpoint()
-    now = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
-    trip_df = pd.DataFrame(data={'receipt_id':None,
-                                'merchant_id':merchant_id,
-                                'trip_datetime':trip_dt,
-                                'upload_datetime':now,
-                                'subtotal':receipt['subtotal'],
-                                'tax':receipt['tax'],
-                                'total':receipt['total']},
-                            index=[0])
-    insert_to_receipts(trip_df)
-
-    # preparing purchases
-    trip_id = get_trip_id(trip_dt)
-    purchase_df = items[['item_cost',
-                         'description',
-                        'quantity',
-                        'flag',
-                        'unit_price', 
-                        'notes',
-                        'discount']].copy()
-    purchase_df['purchases_id'] = None
-    purchase_df['merchant_id'] = merchant_id
-    purchase_df['receipt_id'] = trip_id
-    # getting item ids based on matching description and merchant_id
-    purchase_dict = get_item_ids(items['description'].to_list(), merchant_id)
-    purchase_df['item_id'] = purchase_df['description'].map(purchase_dict)
-    
+def _upload_capture(paths, con=None, rules=None):
+    # the json files of one capture, several parts make one receipt
+    data = []
+    for path in paths:
+        with instrument.span('db.read_json'), open(path, 'rb') as f_in:
+            data.append(f_in.read())
+    entries = [journal.entry(path, d, status='loaded') for path, d in zip(paths, data)]
+    with transaction(con) as con:
+        found = journal.known(con, [e['file_hash'] for e in entries])
+        done = [found.get(e['file_hash']) for e in entries]
+        if all(f is not None and f[0] != 'quarantined' for f in done):
+            print(f"{', '.join(paths)} is already {done[0][0]}, receipt_id {done[0][1]}")
+            return [done[0][1]]
+        receipts = response_receipts([json.loads(d) for d in data])
+        receipt_ids = [_upload_receipt(receipt, con, rules) for receipt in receipts]
+        journal.record(con, [dict(e, receipt_id=receipt_ids[0]) for e in entries])
+    return receipt_ids
+
+def upload_responses(filenames, con=None, rules=None):
+    """
+        loads a batch of json files from the json folder, all or nothing.
+        The parts of a long receipt (name_part1.json, name_part2.json, ...)
+        are stitched into one. With rules the whole batch is written in one
+        pass with an insert per table (see bulk_load.write_parsed) instead
+        of receipt by receipt
+    """
+    import bulk_load
+    paths = [f"json/{filename}" for filename in filenames]
+    with transaction(con) as con:
+        if rules is None:
+            for group in bulk_load.captures(paths):
+                _upload_capture(group, con)
+            return
+        loaded, purchases, skipped, bad = bulk_load.write_parsed(
+            bulk_load.parse_files(paths, rules), con)
+        if bad:
+            raise ValueError('; '.join(f"{b['file']}: {b['error']}" for b in bad))
+        print(f'Loaded {loaded} receipts with {purchases} purchases, '
+              f'{skipped} files already loaded')
+
+# split rules for a load that asks on the terminal, so only the defaults
+ASK_RULES = {'merchants': {}, 'items': []}
+
+def ask_discount_approval(rows):
+    print(rows)
+    return input('Do you approve deleting the discount row and writing the \
+                 item_cost to the discount value in the previous row? y/n\n')=='y'
+
+def _show(items, rows, columns):
+    # some rows of transform's item columns as a dataframe, just for printing
+    import pandas as pd
+    return pd.DataFrame({c:[items[c][i] for i in rows] for c in columns}, index=rows)
+
+def ask_split(items):
     # This part is under construction
     # Eventually I would like to make a GUI and add dynamic options
     # This works well enough for now...
-    purchase_df['creditor'] = 2 # default is my friend with costco card
-    purchase_df['debtor'] = 1 # default is me
-    purchase_df['debt_multiplier'] = 0.4 # we agreed on 40%
-
-    print(purchase_df[['description','item_cost', 'creditor','debtor']])
+    print(_show(items, range(len(items['description'])),
+                ['description', 'item_cost', 'creditor', 'debtor']))
     print('This is your chance to change debt_multiplier easily!')
-    # I may skip this part for now
-    me = input('Type the ids of the values that should be paid only by me').split(' ')
+    me = input('Type the ids of the values that should be paid only by me').split()
     me = [int(x) for x in me]
-    fr = input('Type the ids of the values that should be paid only by friend').split(' ')
+    fr = input('Type the ids of the values that should be paid only by friend').split()
     fr = [int(x) for x in fr]
-    if me[0] != '':
-        purchase_df.loc[me, 'debt_multiplier'] = 1
-    if fr[0] != '':
-        purchase_df.loc[fr, 'debtor'] = 2 # friend
-        purchase_df.loc[fr, 'debt_multiplier'] = 1
-    purchase_df.drop(columns='description', inplace=True)
-    purchase_df['purchase_id'] = None
-    insert_to_purchases(purchase_df)
-
-    # preparing shared_payments
-    # later I want to generalize this for more than 2 ppl
-    purchase_df['final_price'] = (purchase_df['item_cost'] + purchase_df['discount']) * purchase_df['debt_multiplier']
-    # creates a df with total amount paid by each person
-    shared_payments_df = purchase_df[['creditor','debtor','final_price']].groupby(['debtor','creditor']).sum().reset_index()
-    shared_payments_df['is_paid'] = 0 # false; sqlite doesn't support boolean
-    shared_payments_df.rename(columns={'final_price':'amount_owed'}, inplace=True)
-    # filters out rows where debtor and creditor are equal
-    shared_payments_df = shared_payments_df[shared_payments_df['creditor'] != shared_payments_df['debtor']].copy()
-    shared_payments_df['shared_payment_id'] = None
-    shared_payments_df['receipt_id'] = trip_id
-    shared_payments_df['paid_datetime'] = None
-    insert_to_shared_payments(shared_payments_df) 
+    for i in me:
+        items['debt_multiplier'][i] = 1
+    for i in fr:
+        items['debtor'][i] = 2 # friend
+        items['debt_multiplier'][i] = 1
+
+def _upload_receipt(receipt, con, rules=None):
+    """
+        writes one receipt in the caller's transaction. It is parsed, its
+        discounts folded and its split worked out by transform, like a bulk
+        load. rules=None asks about discounts and splits on the terminal
+    """
+    with instrument.span('db.parse_items'):
+        batch = transform([receipt], ASK_RULES if rules is None else rules)
+    if batch['bad']:
+        # transform keeps the error as 'ValueError: message'
+        raise ValueError(batch['bad'][0][1].split(': ', 1)[-1])
+    items = batch['items']
+    if rules is None:
+        discounted = [i for i, d in enumerate(items['discount'].tolist()) if d]
+        if discounted and not ask_discount_approval(
+                _show(items, discounted, ['description', 'item_cost', 'discount'])):
+            raise ValueError('Not approved. Exiting!!')
+    _, trip_dt, subtotal, tax, total = batch['trips'][0]
+
+    # load merchant to db if not already there
+    merchant_id = insert_to_merchants([tuple(batch['merchants'][0].values())], con)[0]
+
+    # load the items if not already there
+    item_ids = get_or_create_item_ids(items['description'], merchant_id, con)
+
+    now = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
+    trip_id = insert_to_receipts(
+        [(None, merchant_id, trip_dt, now, subtotal, tax, total)], con)[0]
+
+    with instrument.span('db.split'):
+        if rules is None:
+            ask_split(items)
+    insert_to_purchases(list(zip(
+        repeat(None),
+        repeat(trip_id),
+        repeat(merchant_id),
+        [item_ids.get(d) for d in items['description']],
+        items['item_cost'].tolist(),
+        items['discount'].tolist(),
+        items['quantity'],
+        items['unit_price'],
+        items['flag'],
+        items['notes'],
+        items['creditor'].tolist(),
+        items['debtor'].tolist(),
+        items['debt_multiplier'].tolist(),
+    )), con)
+
+    # the purchases triggers marked this receipt dirty
+    settlement.recalculate(con)
     print("Finished last insert!")
+    return trip_id
 
-def recalculate_shared_payment(receipt_id):
+def recalculate_shared_payment(receipt_id, con=None):
     """
         supply a shopping trip id to recalculate amount_owed in shared_payments
     """
-    with sqlite3.connect(DB_NAME) as con:
-        cur = con.cursor()
-        params = {'receipt_id':receipt_id}        
-        sql = """
-        UPDATE shared_payments
-        SET amount_owed = (
-            SELECT sum((item_cost + discount)) * debt_multiplier
-            FROM purchases
-            WHERE receipt_id = :receipt_id
-            and debtor = 1
-        )
-        WHERE receipt_id = :receipt_id
-        """
-        cur.execute(sql, params)
-        con.commit()
+    with transaction(con) as con:
+        settlement.recalculate(con, [receipt_id])
 
-def get_recent_purchases():
-    with sqlite3.connect(DB_NAME) as con:
-        sql = """
-          select sum((item_cost + discount)) as subtotal
-          from purchases
-          where receipt_id = ( 
-              select receipt_id 
-              from receipts
-              order by receipt_id desc
-              limit 1
-             )
-        """
+RECENT_PURCHASES_SQL = """
+      select sum((item_cost + discount)) as subtotal
+      from purchases
+      where receipt_id = ( 
+          select receipt_id 
+          from receipts
+          order by receipt_id desc
+          limit 1
+         )
+    """
+
+def get_recent_purchases(con=None):
+    import pandas as pd
+    with transaction(con) as con:
+        sql = RECENT_PURCHASES_SQL
         res = pd.read_sql(sql=sql, con=con)
     return res
 
-def get_recent_receipt():
-    with sqlite3.connect(DB_NAME) as con:
-        sql = """
-            select * 
-            from receipts
-            order by receipt_id desc
-            limit 1
-        """
+RECENT_RECEIPT_SQL = """
+        select * 
+        from receipts
+        order by receipt_id desc
+        limit 1
+    """
+
+def get_recent_receipt(con=None):
+    import pandas as pd
+    with transaction(con) as con:
+        sql = RECENT_RECEIPT_SQL
         res = pd.read_sql(sql=sql, con=con)
     return res
 
-def get_recent_shared_payment():
-    with sqlite3.connect(DB_NAME) as con:
-        sql = """
-          select *
-          from shared_payments
-          where receipt_id = ( 
-              select receipt_id 
-              from receipts
-              order by receipt_id desc
-              limit 1
-             )
-        """
+RECENT_SHARED_PAYMENT_SQL = """
+      select *
+      from shared_payments
+      where receipt_id = ( 
+          select receipt_id 
+          from receipts
+          order by receipt_id desc
+          limit 1
+         )
+    """
+
+def get_recent_shared_payment(con=None):
+    import pandas as pd
+    with transaction(con) as con:
+        sql = RECENT_SHARED_PAYMENT_SQL
         res = pd.read_sql(sql=sql, con=con)
     return res
 
-def generate_report():
-    with sqlite3.connect(DB_NAME) as con:
-        sql = """
-          select
-              i.description,
-              p.item_cost,
-              p.discount,
-              (p.item_cost + p.discount) as net_cost,
-              p.debt_multiplier as debt_fraction,
-              p1.name as creditor_name,
-              p2.name as debtor_name,
-              r.trip_datetime
-          from purchases p
-              inner join merchants m on 
-                  p.merchant_id = m.merchant_id
-              inner join receipts r on 
-                  p.receipt_id = r.receipt_id
-              inner join items i on 
-                  p.item_id = i.item_id
-              inner join participants p1 on
-                  p.creditor = p1.participant_id
-              inner join participants p2 on
-                  p.debtor = p2.participant_id
-          where r.receipt_id = ( 
-              select receipt_id 
-              from receipts
-              order by receipt_id desc
-              limit 1
-             )
-        """
+REPORT_SQL = """
+      select
+          i.description,
+          p.item_cost,
+          p.discount,
+          (p.item_cost + p.discount) as net_cost,
+          p.debt_multiplier as debt_fraction,
+          p1.name as creditor_name,
+          p2.name as debtor_name,
+          r.trip_datetime
+      from purchases p
+          inner join merchants m on 
+              p.merchant_id = m.merchant_id
+          inner join receipts r on 
+              p.receipt_id = r.receipt_id
+          inner join items i on 
+              p.item_id = i.item_id
+          inner join participants p1 on
+              p.creditor = p1.participant_id
+          inner join participants p2 on
+              p.debtor = p2.participant_id
+      where r.receipt_id = ( 
+          select receipt_id 
+          from receipts
+          order by receipt_id desc
+          limit 1
+         )
+    """
+
+def generate_report(con=None):
+    import pandas as pd
+    with transaction(con) as con:
+        sql = REPORT_SQL
         res = pd.read_sql(sql=sql, con=con)
     return res
 
-def main(img_path=None):
+# the queries migrations.py --check runs through EXPLAIN QUERY PLAN
+REPORT_QUERIES = {
+    'recalculate_shared_payment': (settlement.RECALCULATE_SQL, {}),
+    'get_recent_purchases': (RECENT_PURCHASES_SQL, {}),
+    'get_recent_receipt': (RECENT_RECEIPT_SQL, {}),
+    'get_recent_shared_payment': (RECENT_SHARED_PAYMENT_SQL, {}),
+    'generate_report': (REPORT_SQL, {}),
+    'reports date range': reports.build_query(start='2023-01-01', end='2023-01-31'),
+    'reports by month and merchant': reports.build_query(
+        start='2023-01', end='2023-12', group_by=['month', 'merchant']),
+    'reports for a participant': reports.build_query(
+        start='2023-01', end='2023-01', participants=[2]),
+    'search item descriptions': reports.build_query(match='"dog" AND "food"'),
+}
+
+def main(img_path=None, use_cache=True):
     if img_path == None:
         img_path = input('Enter the receipt pic filename:\n')
-    res = ocr_api.get_results(img_path)
-    upload_response(res)
+    import dedup
+    import ocr_api
+    # served from the ocr cache when this image was already recognized,
+    # otherwise counted against the daily call budget in ocr_calls.json
+    try:
+        json_file = ocr_api.main(img_path, use_cache=use_cache,
+                                 deduplicator=dedup.open_deduplicator(DB_NAME))
+    except dedup.DuplicateImage as e:
+        print(e)
+        return
+    upload_response(os.path.basename(json_file))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,245 @@
+import datetime
+import hashlib
+import io
+import sqlite3
+import threading
+from itertools import combinations
+
+import instrument
+import preprocess
+from migrations import DB_NAME
+
+# Catches a second photo of a receipt that was already sent to the ocr api
+# before a call is spent on it. Each image gets a 64 bit perceptual hash (the
+# low frequencies of a DCT of the grayscale receipt, like pHash). The photo
+# is straightened first, turning it until the text rows line up with the
+# pixel rows, and cut down to the paper inside its edges, so the hash barely
+# moves with the angle, resolution, jpeg quality or framing. On generated
+# receipts, retakes up to 5 degrees askew come out 0-6 bits from the first
+# photo and different receipts from the same store 12 or more. Hashes are
+# kept in the image_hashes table and in a multi-index hash table in memory,
+# see HammingIndex. Pillow and numpy are imported when an image is hashed so
+# ocr_api can offer this without loading them.
+
+HASH_SIZE = 8 # the hash is the sign of the HASH_SIZE x HASH_SIZE lowest frequencies
+SAMPLE = 32 # side of the grayscale image the DCT runs on
+MAX_DISTANCE = 8 # bits two hashes may differ by and still be the same receipt
+BANDS = 4 # 16 bit pieces each hash is indexed under
+MAX_SKEW = 10 # degrees a photo is straightened by at most
+SKEW_SIZE = 300 # side of the thumbnail the skew is measured on
+INSET = 0.08 # fraction of the paper left out on each side, its edges move between photos
+
+class DuplicateImage(Exception):
+    pass
+
+def _dct_matrix(n):
+    import numpy as np
+    k = np.arange(n)
+    return np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+
+_dct = None
+
+def skew_angle(gray):
+    """
+        the degrees to turn gray by so its text rows run along the pixel
+        rows: the angle where the ink summed along each row changes the most
+        from one row to the next. Whole degrees up to MAX_SKEW, then quarters
+    """
+    import numpy as np
+    from PIL import Image, ImageOps
+    small = gray.copy()
+    small.thumbnail((SKEW_SIZE, SKEW_SIZE))
+    ink = ImageOps.invert(small) # corners rotated in are blank paper
+    def score(angle):
+        rotated = ink.rotate(angle, resample=Image.Resampling.BILINEAR)
+        return np.diff(np.asarray(rotated, dtype=float).sum(axis=1)).var()
+    best = max(np.arange(-MAX_SKEW, MAX_SKEW + 0.5, 1.0), key=score)
+    return float(max(np.arange(best - 0.75, best + 0.8, 0.25), key=score))
+
+def image_hash(data):
+    """
+        the perceptual hash of image bytes as an unsigned 64 bit int, or None
+        for anything Pillow can't read. The photo is auto-oriented,
+        straightened and cut down to the paper first
+    """
+    global _dct
+    import numpy as np
+    from PIL import Image, ImageOps
+    try:
+        image = Image.open(io.BytesIO(data))
+        # jpegs decode straight to a small size, large enough to see text rows
+        image.draft('L', (512, 512))
+        image.load()
+    except (OSError, Image.DecompressionBombError):
+        return None
+    gray = ImageOps.exif_transpose(image).convert('L')
+    box = preprocess.find_receipt(gray, margin=0)
+    angle = skew_angle(gray.crop(box) if box is not None else gray)
+    if angle:
+        # fill the corners rotated in with the background along the top and bottom
+        fill = int(np.median(np.asarray(gray)[[0, -1], :]))
+        gray = gray.rotate(angle, resample=Image.Resampling.BICUBIC, fillcolor=fill)
+        box = preprocess.find_receipt(gray, margin=0)
+    if box is not None:
+        left, top, right, bottom = box
+        dx, dy = (right - left) * INSET, (bottom - top) * INSET
+        gray = gray.crop((int(left + dx), int(top + dy), int(right - dx), int(bottom - dy)))
+    pixels = np.asarray(gray.resize((SAMPLE, SAMPLE), Image.Resampling.LANCZOS), dtype=float)
+    if _dct is None:
+        _dct = _dct_matrix(SAMPLE)
+    low = (_dct @ pixels @ _dct.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # the first coefficient is the overall brightness, leave it out of the median
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+def _signed(h):
+    # sqlite integers are signed 64 bit
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+def _unsigned(h):
+    return h + (1 << 64) if h < 0 else h
+
+class HammingIndex:
+    """
+        multi-index hashing: each hash is cut into BANDS pieces of 16 bits and
+        filed under every piece. Two hashes within max_distance bits are within
+        max_distance // BANDS bits on at least one piece, so a search only
+        looks up the pieces that close to the query's instead of comparing it
+        with every stored hash. (A BK-tree visits most of its nodes at this
+        distance on 64 bit hashes.)
+    """
+    def __init__(self, max_distance=MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.bits = 64 // BANDS
+        radius = max_distance // BANDS
+        self.masks = [sum(1 << b for b in flipped)
+                      for k in range(radius + 1)
+                      for flipped in combinations(range(self.bits), k)]
+        self.tables = [{} for _ in range(BANDS)]
+        self.size = 0
+
+    def _pieces(self, h):
+        mask = (1 << self.bits) - 1
+        return [(h >> (self.bits * band)) & mask for band in range(BANDS)]
+
+    def add(self, h, value):
+        for table, piece in zip(self.tables, self._pieces(h)):
+            table.setdefault(piece, []).append((h, value))
+        self.size += 1
+
+    def remove(self, h, value):
+        for table, piece in zip(self.tables, self._pieces(h)):
+            table[piece].remove((h, value))
+        self.size -= 1
+
+    def search(self, h):
+        # [(distance, value)] within max_distance of h, closest first
+        found = {}
+        for table, piece in zip(self.tables, self._pieces(h)):
+            for mask in self.masks:
+                for other, value in table.get(piece ^ mask, ()):
+                    distance = (other ^ h).bit_count()
+                    if distance <= self.max_distance:
+                        found[value] = distance
+        return sorted((d, v) for v, d in found.items())
+
+class Deduplicator:
+    """
+        the stored hashes, safe to share between ocr threads. check() looks
+        up and adds under one lock, so two photos of the same receipt in one
+        batch can't both get through. The hash it adds stays pending until
+        the ocr call is done: confirm() stores it, forget() drops it again
+        when the call failed so the photo isn't lost as a duplicate
+    """
+    def __init__(self, db=DB_NAME, max_distance=MAX_DISTANCE):
+        self.con = instrument.connect(db, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.index = HammingIndex(max_distance)
+        for sha, h, path in self.con.execute('select image_sha256, phash, path from image_hashes'):
+            self.index.add(_unsigned(h), (path, sha))
+        self.pending = {} # sha256 -> (hash, path) of photos being OCRed
+        self.duplicates = 0
+
+    def check(self, image_path, data):
+        """
+            raises DuplicateImage when a stored or pending image looks like
+            the same receipt, otherwise adds this one as pending and returns
+            its sha256 for confirm() or forget(). Returns None when there is
+            nothing to keep: the image can't be read or the same bytes are
+            already known, they are never a duplicate of themselves
+        """
+        with instrument.span('dedup.hash'):
+            h = image_hash(data)
+        if h is None:
+            return
+        sha = hashlib.sha256(data).hexdigest()
+        with self.lock, instrument.span('dedup.lookup'):
+            found = self.index.search(h)
+            if any(other == sha for _, (_, other) in found):
+                return
+            if found:
+                self.duplicates += 1
+                distance, (path, _) = found[0]
+                raise DuplicateImage(f'{image_path} looks like {path} '
+                                     f'({distance} of 64 bits differ), not OCRed')
+            self.index.add(h, (image_path, sha))
+            self.pending[sha] = (h, image_path)
+        return sha
+
+    def confirm(self, sha):
+        # the photo was OCRed, store its hash
+        with self.lock:
+            h, image_path = self.pending.pop(sha)
+            now = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
+            self.con.execute('INSERT OR IGNORE INTO image_hashes VALUES (?, ?, ?, ?)',
+                             (sha, _signed(h), image_path, now))
+            self.con.commit()
+
+    def forget(self, sha):
+        # the ocr call failed, the next photo of this receipt may try again
+        with self.lock:
+            h, image_path = self.pending.pop(sha)
+            self.index.remove(h, (image_path, sha))
+
+    def close(self):
+        self.con.close()
+
+def open_deduplicator(db=DB_NAME, max_distance=MAX_DISTANCE):
+    # a Deduplicator, or None with a note when the database isn't migrated yet
+    try:
+        return Deduplicator(db, max_distance)
+    except sqlite3.OperationalError:
+        print(f'No image_hashes table in {db}, run migrations.py to skip duplicate photos')
+        return None
+
+def add_arguments(parser):
+    parser.add_argument('images', help='a folder or glob of images')
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--max-distance', type=int, default=MAX_DISTANCE)
+
+def run(args):
+    # stores the hashes of images OCRed before dedup existed and lists the duplicates
+    import ocr_api
+    dedup = open_deduplicator(args.db, args.max_distance)
+    if dedup is None:
+        return
+    images = ocr_api.find_images(args.images)
+    for path in images:
+        with open(path, 'rb') as f:
+            data = f.read()
+        try:
+            sha = dedup.check(path, data)
+        except DuplicateImage as e:
+            print(e)
+            continue
+        if sha is not None:
+            dedup.confirm(sha)
+    print(f'{len(images)} images, {dedup.duplicates} duplicates, '
+          f'{dedup.index.size} hashes stored')
+    dedup.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Find photos of the same receipt')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,190 @@
+import json
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+# Timing spans around each pipeline stage and optional sql tracing.
+# Everything is off until enable() is called, a disabled span is a shared
+# no-op context manager so the instrumented code runs at full speed.
+#   instrument.enable(sql=True)
+#   ... run a load ...
+#   instrument.write('profile.json') # or profile.prom for prometheus
+
+enabled = False
+sql_enabled = False
+_lock = threading.Lock()
+_spans = {} # name -> [count, seconds, max seconds]
+_sql = {} # statement -> [executions, seconds, max seconds]
+_statements = {} # statement as sqlite ran it, literals removed -> count
+_NOOP = nullcontext()
+
+def enable(sql=False):
+    global enabled, sql_enabled
+    enabled = True
+    sql_enabled = sql
+
+def disable():
+    global enabled, sql_enabled
+    enabled = sql_enabled = False
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _sql.clear()
+        _statements.clear()
+
+def _add(table, key, seconds, count=1):
+    with _lock:
+        stats = table.get(key)
+        if stats is None:
+            table[key] = [count, seconds, seconds]
+        else:
+            stats[0] += count
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+@contextmanager
+def _timed(name):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        _add(_spans, name, perf_counter() - start)
+
+def span(name):
+    # with span('ocr.http_post'): ...
+    if not enabled:
+        return _NOOP
+    return _timed(name)
+
+def _clean(sql):
+    return ' '.join(sql.split())
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|-?\b\d+(?:\.\d+)?\b")
+
+class Cursor(sqlite3.Cursor):
+    # times every statement, fetches included, under its parameterized sql
+    sql = None
+
+    def _run(self, method, sql, *args):
+        self.sql = _clean(sql)
+        start = perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            _add(_sql, self.sql, perf_counter() - start)
+
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self._run(super().executescript, sql_script)
+
+    def _fetch(self, method, *args):
+        start = perf_counter()
+        try:
+            return method(*args)
+        finally:
+            if self.sql is not None:
+                _add(_sql, self.sql, perf_counter() - start, count=0)
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, size or self.arraysize)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+class Connection(sqlite3.Connection):
+    """
+        sqlite3 connection that times statements run through its cursors and
+        counts every statement sqlite runs (trigger bodies and each row of an
+        executemany included) with set_trace_callback
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_trace_callback(self._trace)
+
+    @staticmethod
+    def _trace(statement):
+        key = LITERALS.sub('?', _clean(statement))
+        with _lock:
+            _statements[key] = _statements.get(key, 0) + 1
+
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+def connect(database, **kwargs):
+    # sqlite3.connect, traced when enable(sql=True) was called
+    if sql_enabled:
+        kwargs['factory'] = Connection
+    return sqlite3.connect(database, **kwargs)
+
+def _stats(table, count_name):
+    return {k:{count_name: v[0], 'seconds': round(v[1], 6), 'max_seconds': round(v[2], 6)}
+            for k, v in sorted(table.items(), key=lambda kv: -kv[1][1])}
+
+def summary():
+    with _lock:
+        return {
+            'spans': _stats(_spans, 'count'),
+            'sql': _stats(_sql, 'executions'),
+            'sqlite_statements': dict(sorted(_statements.items(), key=lambda kv: -kv[1])),
+        }
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus(prefix='spending'):
+    # the summary in the prometheus text exposition format
+    s = summary()
+    metrics = (
+        ('span_seconds_total', 'Time spent in each pipeline stage', 'spans', 'span', 'seconds'),
+        ('span_calls_total', 'Times each pipeline stage ran', 'spans', 'span', 'count'),
+        ('sql_seconds_total', 'Time spent in each sql statement', 'sql', 'statement', 'seconds'),
+        ('sql_calls_total', 'Executions of each sql statement', 'sql', 'statement', 'executions'),
+    )
+    lines = []
+    for name, help, section, label, field in metrics:
+        lines += [f'# HELP {prefix}_{name} {help}', f'# TYPE {prefix}_{name} counter']
+        lines += [f'{prefix}_{name}{{{label}="{_label(k)}"}} {v[field]}'
+                  for k, v in s[section].items()]
+    name = f'{prefix}_sqlite_statements_total'
+    lines += [f'# HELP {name} Statements run by sqlite, trigger bodies included',
+              f'# TYPE {name} counter']
+    lines += [f'{name}{{statement="{_label(k)}"}} {v}'
+              for k, v in s['sqlite_statements'].items()]
+    return '\n'.join(lines) + '\n'
+
+def write(path):
+    # .prom or .txt files get the prometheus format, anything else json
+    if path.endswith(('.prom', '.txt')):
+        text = prometheus()
+    else:
+        text = json.dumps(summary(), indent=4)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def print_summary(limit=10):
+    s = summary()
+    for name, v in s['spans'].items():
+        print(f"{v['seconds']:9.3f}s {v['count']:7} {name}")
+    for sql, v in list(s['sql'].items())[:limit]:
+        print(f"{v['seconds']:9.3f}s {v['executions']:7} {sql[:90]}")
@@ -0,0 +1,78 @@
+import datetime
+import hashlib
+import os
+
+# The ingest_journal table remembers every json file that was loaded,
+# skipped as a duplicate or quarantined, keyed by a hash of its content.
+# A journal row is written in the same transaction as the receipt, so after
+# a crash a file is either fully loaded and journaled or not there at all.
+
+CHUNK = 500 # paths or hashes per lookup query
+
+def file_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def entry(path, data, status=None, receipt_id=None, error=None):
+    # a journal row for the file at path whose bytes are data
+    st = os.stat(path)
+    return {'file_hash': file_hash(data), 'path': os.path.abspath(path),
+            'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'status': status,
+            'receipt_id': receipt_id, 'error': error}
+
+def _chunks(values):
+    for i in range(0, len(values), CHUNK):
+        yield values[i:i + CHUNK]
+
+def unchanged(con, paths, retry_quarantined=False):
+    """
+        the paths journaled with the same size and modification time they
+        have now. Needs only a stat per file and one indexed query per
+        CHUNK paths, no file is read
+    """
+    stats = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stats[os.path.abspath(path)] = (path, st.st_size, st.st_mtime_ns)
+    done = set()
+    for chunk in _chunks(list(stats)):
+        sql = f"""
+            select path, size, mtime_ns, status
+            from ingest_journal
+            where path in ({','.join(['?'] * len(chunk))})
+        """
+        for path, size, mtime_ns, status in con.execute(sql, chunk):
+            if retry_quarantined and status == 'quarantined':
+                continue
+            if stats[path][1:] == (size, mtime_ns):
+                done.add(stats[path][0])
+    return done
+
+def known(con, hashes, retry_quarantined=False):
+    # file_hash -> (status, receipt_id) for the hashes already journaled
+    found = {}
+    for chunk in _chunks(list(hashes)):
+        sql = f"""
+            select file_hash, status, receipt_id
+            from ingest_journal
+            where file_hash in ({','.join(['?'] * len(chunk))})
+        """
+        for file_hash, status, receipt_id in con.execute(sql, chunk):
+            if retry_quarantined and status == 'quarantined':
+                continue
+            found[file_hash] = (status, receipt_id)
+    return found
+
+def record(con, entries):
+    # adds or replaces journal rows, inside the caller's transaction
+    now = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
+    con.executemany("""
+        INSERT OR REPLACE INTO ingest_journal
+        VALUES (:file_hash, :path, :size, :mtime_ns, :status, :receipt_id,
+                :error, :journal_datetime)
+    """, [dict(e, journal_datetime=now) for e in entries])
+
+def counts(con):
+    return dict(con.execute('select status, count(*) from ingest_journal group by status'))
@@ -0,0 +1,725 @@
+import re
+
+import instrument
+
+DB_NAME = "spending_tracker.db"
+
+# Each migration upgrades the schema by one version. The version a database
+# is at is kept in PRAGMA user_version, so running them again is a no-op.
+# Never edit a migration that has shipped, add a new one instead.
+
+def _create_tables(cur):
+    # Create the merchants table
+    # A new merchant will likely be created for each store number 
+    # the name field can be used to track trips to the same chain
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS merchants (
+            merchant_id INTEGER PRIMARY KEY,
+            ocr_name TEXT UNIQUE,
+            address TEXT,
+            name TEXT,
+            phone TEXT,
+            website TEXT,
+            city TEXT,
+            state TEXT,
+            zip TEXT,
+            country TEXT
+        )
+    ''')
+
+    # Create the receipts table
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS receipts (
+            receipt_id INTEGER PRIMARY KEY,
+            merchant_id INTEGER,
+            trip_datetime TEXT UNIQUE, -- datetime
+            upload_datetime TEXT, -- datetime
+            subtotal REAL,
+            tax REAL,
+            total REAL,
+            FOREIGN KEY (merchant_id) REFERENCES merchants (merchant_id)
+        )
+    ''')
+
+    # Create the items table
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS items (
+            item_id INTEGER PRIMARY KEY,
+            merchant_id INTEGER,
+            description TEXT,
+            user_descr TEXT,
+            FOREIGN KEY (merchant_id) REFERENCES merchants (merchant_id)
+        )
+    ''')
+
+    # Create the purchases table
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS purchases (
+            purchase_id INTEGER PRIMARY KEY,
+            receipt_id INTEGER,
+            merchant_id INTEGER,
+            item_id INTEGER,
+            item_cost REAL,
+            discount REAL,
+            quantity INTEGER,
+            unit_price REAL,
+            flag TEXT,
+            notes TEXT,
+            creditor INTEGER,
+            debtor INTEGER,
+            debt_multiplier REAL,
+            FOREIGN KEY (receipt_id) REFERENCES receipts (receipt_id),
+            FOREIGN KEY (merchant_id) REFERENCES merchants (merchant_id)
+            FOREIGN KEY (creditor) REFERENCES participants (participant_id)
+            FOREIGN KEY (debtor) REFERENCES participants (participant_id)
+        )
+    ''')
+
+    # Create the participants table
+    # This is for people you share the costs with
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS participants (
+            participant_id INTEGER PRIMARY KEY,
+            name TEXT,
+            email TEXT UNIQUE
+        )
+    ''')
+
+    # Create the shared_payments table
+    # tracks shared payments, supposing the trip should be divided among
+    # multiple people
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS shared_payments (
+            shared_payment_id INTEGER PRIMARY KEY,
+            receipt_id INTEGER,
+            debtor INTEGER,
+            creditor INTEGER,
+            amount_owed INTEGER,
+            is_paid INTEGER, -- boolean
+            paid_datetime TEXT, -- datetime
+            FOREIGN KEY (receipt_id) REFERENCES receipts (receipt_id),
+            FOREIGN KEY (debtor) REFERENCES participants (participant_id),
+            FOREIGN KEY (creditor) REFERENCES participants (participant_id)
+        )
+    ''')
+
+    # Creates a trigger to update the paid_datetime column
+    # from shared_payments table when is_paid is changed
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS update_date_trigger
+        AFTER UPDATE OF is_paid ON shared_payments
+        WHEN new.is_paid = 1
+        BEGIN
+            UPDATE shared_payments
+            SET paid_datetime = DATETIME('now')
+            WHERE id = new.id;
+        END;
+    """)
+
+    # Create the BEFORE INSERT trigger on receipts table
+    # checks to make sure the same datetime isn't added twice
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS check_duplicate_trip_datetime
+        BEFORE INSERT ON receipts
+        BEGIN
+            SELECT CASE
+            WHEN EXISTS (SELECT 1 FROM receipts WHERE trip_datetime = NEW.trip_datetime) THEN
+            RAISE(ABORT, 'Duplicate trip_datetime detected. Record not inserted.')
+        END;
+        END;
+    ''')
+
+def _unique_items(cur):
+    # One row per description at each merchant. Older databases may
+    # have duplicates, so point their purchases at the first copy and
+    # drop the rest before the unique index is built
+    cur.execute('''
+        CREATE TEMP TABLE item_dupes AS
+        SELECT i.item_id, k.keep_id
+        FROM items i
+            inner join (
+                SELECT merchant_id, description, min(item_id) as keep_id
+                FROM items
+                GROUP BY merchant_id, description
+            ) k on
+                i.merchant_id = k.merchant_id
+                and i.description = k.description
+        WHERE i.item_id != k.keep_id
+    ''')
+    cur.execute('''
+        UPDATE purchases
+        SET item_id = (SELECT keep_id FROM item_dupes d WHERE d.item_id = purchases.item_id)
+        WHERE item_id IN (SELECT item_id FROM item_dupes)
+    ''')
+    cur.execute('DELETE FROM items WHERE item_id IN (SELECT item_id FROM item_dupes)')
+    cur.execute('DROP TABLE item_dupes')
+    cur.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS items_merchant_description
+        ON items (merchant_id, description)
+    ''')
+
+def _report_indexes(cur):
+    # update_date_trigger pointed at an id column that doesn't exist
+    cur.execute('DROP TRIGGER IF EXISTS update_date_trigger')
+    cur.execute("""
+        CREATE TRIGGER update_date_trigger
+        AFTER UPDATE OF is_paid ON shared_payments
+        WHEN new.is_paid = 1
+        BEGIN
+            UPDATE shared_payments
+            SET paid_datetime = DATETIME('now')
+            WHERE shared_payment_id = new.shared_payment_id;
+        END;
+    """)
+
+    # covers every column the per-receipt reports and
+    # recalculate_shared_payment read, so they never touch the table itself
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS purchases_receipt
+        ON purchases (receipt_id, debtor, creditor, item_id, merchant_id,
+                      item_cost, discount, debt_multiplier)
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS purchases_item
+        ON purchases (item_id, receipt_id)
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS purchases_merchant
+        ON purchases (merchant_id, receipt_id)
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS shared_payments_receipt
+        ON shared_payments (receipt_id)
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS receipts_merchant
+        ON receipts (merchant_id, trip_datetime)
+    ''')
+    cur.execute('ANALYZE')
+
+# (table, period column, length of the trip_datetime prefix it keeps)
+ROLLUPS = (('spend_daily', 'day', 10), ('spend_monthly', 'month', 7))
+
+def rollup_parts(r):
+    """
+        what one purchase row r adds to the rollups: its net cost for the
+        merchant and the item, the debtor's share for the debtor and the
+        rest for the creditor. (dimension, key, amount, purchases) sql
+    """
+    net = f'(coalesce({r}.item_cost, 0) + coalesce({r}.discount, 0))'
+    share = f'coalesce({r}.debt_multiplier, 1)'
+    return [
+        ("'merchant'", f'coalesce({r}.merchant_id, 0)', net, 1),
+        ("'item'", f'coalesce({r}.item_id, 0)', net, 1),
+        ("'participant'", f'coalesce({r}.debtor, 0)', f'{net} * {share}', 1),
+        ("'participant'", f'coalesce({r}.creditor, 0)', f'{net} * (1 - {share})', 0),
+    ]
+
+def _rollup_upsert(table, period, length, r, sign):
+    # adds (sign=1) or takes away (sign=-1) one purchase row from a rollup
+    rows = ' UNION ALL '.join(
+        f'SELECT {d} as dimension, {k} as key, {a} as amount, {n} as purchases'
+        for d, k, a, n in rollup_parts(r))
+    return f"""
+        INSERT INTO {table} ({period}, dimension, key, amount, purchases)
+        SELECT substr(t.trip_datetime, 1, {length}), v.dimension, v.key,
+               {sign} * v.amount, {sign} * v.purchases
+        FROM receipts t, ({rows}) v
+        WHERE t.receipt_id = {r}.receipt_id
+        ON CONFLICT (dimension, key, {period}) DO UPDATE SET
+            amount = amount + excluded.amount,
+            purchases = purchases + excluded.purchases;
+    """
+
+def rollup_totals_sql(length):
+    # the rollup rows recomputed from scratch, used to fill and check them
+    rows = ' UNION ALL '.join(f"""
+        SELECT substr(t.trip_datetime, 1, {length}) as period, {d} as dimension,
+               {k} as key, {a} as amount, {n} as purchases
+        FROM purchases p
+            inner join receipts t on
+                t.receipt_id = p.receipt_id"""
+        for d, k, a, n in rollup_parts('p'))
+    return f"""
+        SELECT period, dimension, key, sum(amount) as amount, sum(purchases) as purchases
+        FROM ({rows})
+        GROUP BY period, dimension, key
+    """
+
+def _spend_rollups(cur):
+    # spend per merchant, item and participant by day and by month,
+    # kept up to date by triggers on purchases. rollups.py can rebuild
+    # and check them
+    for table, period, _ in ROLLUPS:
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                {period} TEXT,
+                dimension TEXT, -- merchant, item or participant
+                key INTEGER, -- merchant_id, item_id or participant_id
+                amount REAL,
+                purchases INTEGER,
+                PRIMARY KEY (dimension, key, {period})
+            ) WITHOUT ROWID
+        ''')
+        cur.execute(f'''
+            CREATE INDEX IF NOT EXISTS {table}_period
+            ON {table} ({period}, dimension, key, amount)
+        ''')
+    both = lambda r, sign: ''.join(_rollup_upsert(table, period, length, r, sign)
+                                   for table, period, length in ROLLUPS)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS purchases_rollup_insert
+        AFTER INSERT ON purchases
+        BEGIN {both('new', 1)} END;
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS purchases_rollup_delete
+        AFTER DELETE ON purchases
+        BEGIN {both('old', -1)} END;
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS purchases_rollup_update
+        AFTER UPDATE OF receipt_id, merchant_id, item_id, item_cost, discount,
+                        creditor, debtor, debt_multiplier ON purchases
+        BEGIN {both('old', -1)} {both('new', 1)} END;
+    """)
+    # fill them from whatever is already loaded
+    for table, period, length in ROLLUPS:
+        cur.execute(f"""
+            INSERT INTO {table} ({period}, dimension, key, amount, purchases)
+            {rollup_totals_sql(length)}
+        """)
+
+def _watermark(cur):
+    # a counter bumped on every change to the tables reports read, so
+    # cached report results know when they are stale
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS watermark (
+            name TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    ''')
+    cur.execute("INSERT OR IGNORE INTO watermark VALUES ('ingest', 0)")
+    for table in ('merchants', 'receipts', 'items', 'purchases', 'participants'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_watermark_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE watermark SET value = value + 1 WHERE name = 'ingest';
+                END;
+            """)
+
+def _dirty_receipts(cur):
+    # insert_to_shared_payments used to write creditor into the debtor
+    # column and the other way round, so every existing row is backwards
+    cur.execute('UPDATE shared_payments SET debtor = creditor, creditor = debtor')
+
+    # receipts whose purchases changed since settlement.py last
+    # recalculated their shared_payments
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS dirty_receipts (
+            receipt_id INTEGER PRIMARY KEY
+        )
+    ''')
+    for event, row in (('INSERT', 'new'), ('UPDATE', 'new'), ('DELETE', 'old')):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS purchases_dirty_{event.lower()}
+            AFTER {event} ON purchases
+            BEGIN
+                INSERT OR IGNORE INTO dirty_receipts VALUES ({row}.receipt_id);
+            END;
+        """)
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS purchases_dirty_update_old
+        AFTER UPDATE OF receipt_id ON purchases
+        BEGIN
+            INSERT OR IGNORE INTO dirty_receipts VALUES (old.receipt_id);
+        END;
+    ''')
+    # amounts were worked out with a single debt_multiplier per receipt,
+    # so recalculate everything once
+    cur.execute('INSERT OR IGNORE INTO dirty_receipts SELECT receipt_id FROM receipts')
+
+def _ingest_journal(cur):
+    # one row per json file content that was loaded or given up on, so
+    # reruns over a folder skip what is already done (see journal.py)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_journal (
+            file_hash TEXT PRIMARY KEY, -- sha256 of the file
+            path TEXT,
+            size INTEGER,
+            mtime_ns INTEGER,
+            status TEXT NOT NULL, -- loaded, duplicate or quarantined
+            receipt_id INTEGER,
+            error TEXT,
+            journal_datetime TEXT,
+            FOREIGN KEY (receipt_id) REFERENCES receipts (receipt_id)
+        )
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS ingest_journal_path
+        ON ingest_journal (path)
+    ''')
+
+def _items_fts(cur):
+    # full-text index over item descriptions for search.py. The trigram
+    # tokenizer matches any part of a word, like the LIKE '%...%' it replaces,
+    # and content='items' keeps the text stored once, in items
+    cur.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+            description,
+            user_descr,
+            content='items',
+            content_rowid='item_id',
+            tokenize='trigram'
+        )
+    ''')
+    delete = '''
+        INSERT INTO items_fts (items_fts, rowid, description, user_descr)
+        VALUES ('delete', old.item_id, old.description, old.user_descr);
+    '''
+    insert = '''
+        INSERT INTO items_fts (rowid, description, user_descr)
+        VALUES (new.item_id, new.description, new.user_descr);
+    '''
+    for event, body in (('INSERT', insert), ('DELETE', delete), ('UPDATE', delete + insert)):
+        cur.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS items_fts_{event.lower()}
+            AFTER {event} ON items
+            BEGIN
+                {body}
+            END;
+        ''')
+    cur.execute("INSERT INTO items_fts (items_fts) VALUES ('rebuild')")
+
+def _item_categories(cur):
+    # the spending category of each item, filled in by categorize.py
+    cur.execute('ALTER TABLE items ADD COLUMN category TEXT')
+    # new items are the only ones without a category, this finds them
+    # without reading the rest of the catalog
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS items_uncategorized
+        ON items (item_id) WHERE category IS NULL
+    ''')
+    # changing a category doesn't need to touch the full-text index
+    cur.execute('DROP TRIGGER IF EXISTS items_fts_update')
+    cur.execute('''
+        CREATE TRIGGER items_fts_update
+        AFTER UPDATE OF description, user_descr ON items
+        BEGIN
+            INSERT INTO items_fts (items_fts, rowid, description, user_descr)
+            VALUES ('delete', old.item_id, old.description, old.user_descr);
+            INSERT INTO items_fts (rowid, description, user_descr)
+            VALUES (new.item_id, new.description, new.user_descr);
+        END;
+    ''')
+
+def _image_hashes(cur):
+    # perceptual hashes of the images sent to the ocr api, so another photo
+    # of the same receipt is caught before it costs a call (see dedup.py)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS image_hashes (
+            image_sha256 TEXT PRIMARY KEY,
+            phash INTEGER NOT NULL, -- 64 bits stored signed, searched in memory
+            path TEXT,
+            hash_datetime TEXT
+        )
+    ''')
+
+def _rehash_images(cur):
+    # dedup.image_hash straightens photos now, the old hashes don't compare
+    # with new ones. python dedup.py <folder> stores them again
+    cur.execute('DELETE FROM image_hashes')
+
+def _rollup_move(table, period, length, t, sign):
+    # adds (sign=1) or takes away (sign=-1) every purchase of receipt t,
+    # filed under t's trip_datetime
+    rows = ' UNION ALL '.join(
+        f'SELECT {d} as dimension, {k} as key, {a} as amount, {n} as purchases '
+        f'FROM purchases p WHERE p.receipt_id = {t}.receipt_id'
+        for d, k, a, n in rollup_parts('p'))
+    return f"""
+        INSERT INTO {table} ({period}, dimension, key, amount, purchases)
+        SELECT substr({t}.trip_datetime, 1, {length}), v.dimension, v.key,
+               {sign} * v.amount, {sign} * v.purchases
+        FROM ({rows}) v
+        WHERE true
+        ON CONFLICT (dimension, key, {period}) DO UPDATE SET
+            amount = amount + excluded.amount,
+            purchases = purchases + excluded.purchases;
+    """
+
+def _rollup_trip_moves(cur):
+    # the purchase triggers can't see a receipt's trip_datetime change, so
+    # its purchases move from the old day and month to the new ones here
+    move = lambda t, sign: ''.join(_rollup_move(table, period, length, t, sign)
+                                   for table, period, length in ROLLUPS)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS receipts_rollup_update
+        AFTER UPDATE OF trip_datetime ON receipts
+        WHEN old.trip_datetime IS NOT new.trip_datetime
+        BEGIN {move('old', -1)} {move('new', 1)} END;
+    """)
+    # and put right whatever was moved before
+    for table, period, length in ROLLUPS:
+        cur.execute(f'DELETE FROM {table}')
+        cur.execute(f"""
+            INSERT INTO {table} ({period}, dimension, key, amount, purchases)
+            {rollup_totals_sql(length)}
+        """)
+
+def price_parts(r):
+    # (amount, quantity) one purchase row r adds to its item's price history.
+    # Prices are shelf prices, item_cost before discounts, per unit
+    quantity = f'CASE WHEN cast({r}.quantity AS REAL) > 0 THEN cast({r}.quantity AS REAL) ELSE 1 END'
+    return f'coalesce({r}.item_cost, 0)', quantity
+
+def _price_upsert(r, sign):
+    # adds (sign=1) or takes away (sign=-1) one purchase row from the history
+    amount, quantity = price_parts(r)
+    sql = f"""
+        INSERT INTO price_history (item_id, trip_datetime, amount, quantity, purchases)
+        SELECT {r}.item_id, t.trip_datetime, {sign} * {amount}, {sign} * {quantity}, {sign}
+        FROM receipts t
+        WHERE t.receipt_id = {r}.receipt_id AND {r}.item_id IS NOT NULL
+        ON CONFLICT (item_id, trip_datetime) DO UPDATE SET
+            amount = amount + excluded.amount,
+            quantity = quantity + excluded.quantity,
+            purchases = purchases + excluded.purchases;
+    """
+    if sign < 0:
+        # an item that wasn't bought on that trip after all has no price there
+        sql += f"""
+        DELETE FROM price_history
+        WHERE item_id = {r}.item_id AND purchases <= 0;
+        """
+    return sql
+
+def price_totals_sql():
+    # the price history recomputed from scratch, used to fill and check it
+    amount, quantity = price_parts('p')
+    return f"""
+        SELECT p.item_id, t.trip_datetime, sum({amount}), sum({quantity}), count(*)
+        FROM purchases p
+            inner join receipts t on
+                t.receipt_id = p.receipt_id
+        WHERE p.item_id IS NOT NULL
+        GROUP BY p.item_id, t.trip_datetime
+    """
+
+def _price_history(cur):
+    # what each item cost on each trip, kept up to date by triggers on
+    # purchases like the rollups, so price queries don't join purchases,
+    # receipts and items. The same item twice on one trip is one row,
+    # unit price = amount / quantity. See prices.py
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS price_history (
+            item_id INTEGER,
+            trip_datetime TEXT,
+            amount REAL, -- item_cost of every purchase of the item on the trip
+            quantity REAL,
+            purchases INTEGER,
+            PRIMARY KEY (item_id, trip_datetime)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS purchases_price_insert
+        AFTER INSERT ON purchases
+        BEGIN {_price_upsert('new', 1)} END;
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS purchases_price_delete
+        AFTER DELETE ON purchases
+        BEGIN {_price_upsert('old', -1)} END;
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS purchases_price_update
+        AFTER UPDATE OF receipt_id, item_id, item_cost, quantity ON purchases
+        BEGIN {_price_upsert('old', -1)} {_price_upsert('new', 1)} END;
+    """)
+    cur.execute(f'INSERT INTO price_history {price_totals_sql()}')
+
+def _price_move(t, sign):
+    # adds (sign=1) or takes away (sign=-1) every purchase of receipt t from
+    # the history under t's trip_datetime
+    amount, quantity = price_parts('p')
+    sql = f"""
+        INSERT INTO price_history (item_id, trip_datetime, amount, quantity, purchases)
+        SELECT p.item_id, {t}.trip_datetime, {sign} * {amount}, {sign} * {quantity}, {sign}
+        FROM purchases p
+        WHERE p.receipt_id = {t}.receipt_id AND p.item_id IS NOT NULL
+        ON CONFLICT (item_id, trip_datetime) DO UPDATE SET
+            amount = amount + excluded.amount,
+            quantity = quantity + excluded.quantity,
+            purchases = purchases + excluded.purchases;
+    """
+    if sign < 0:
+        sql += f"""
+        DELETE FROM price_history
+        WHERE item_id IN (SELECT item_id FROM purchases WHERE receipt_id = {t}.receipt_id)
+            AND trip_datetime = {t}.trip_datetime AND purchases <= 0;
+        """
+    return sql
+
+def _price_trip_moves(cur):
+    # like _rollup_trip_moves, a receipt that changes date moves its prices
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS receipts_price_update
+        AFTER UPDATE OF trip_datetime ON receipts
+        WHEN old.trip_datetime IS NOT new.trip_datetime
+        BEGIN {_price_move('old', -1)} {_price_move('new', 1)} END;
+    """)
+    cur.execute('DELETE FROM price_history')
+    cur.execute(f'INSERT INTO price_history {price_totals_sql()}')
+
+def _bump_months(select):
+    # adds one to the change counter of every month select returns
+    return f"""
+        INSERT INTO month_watermark (month, value)
+        {select}
+        ON CONFLICT (month) DO UPDATE SET value = value + 1;
+    """
+
+def _month_watermark(cur):
+    # a change counter per month of trips, like the ingest watermark, so
+    # snapshot.py only rewrites the months that changed since its last export
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS month_watermark (
+            month TEXT PRIMARY KEY, -- YYYY-MM
+            value INTEGER
+        ) WITHOUT ROWID
+    ''')
+    receipt_month = lambda r: _bump_months(f"""
+        SELECT substr(t.trip_datetime, 1, 7), 1
+        FROM receipts t
+        WHERE t.receipt_id = {r}.receipt_id""")
+    for event, row in (('INSERT', 'new'), ('DELETE', 'old')):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS purchases_month_{event.lower()}
+            AFTER {event} ON purchases
+            BEGIN {receipt_month(row)} END;
+        """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS purchases_month_update
+        AFTER UPDATE ON purchases
+        BEGIN {receipt_month('old')} {receipt_month('new')} END;
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS receipts_month_update
+        AFTER UPDATE OF trip_datetime ON receipts
+        BEGIN
+            {_bump_months("SELECT substr(old.trip_datetime, 1, 7), 1 WHERE true")}
+            {_bump_months("SELECT substr(new.trip_datetime, 1, 7), 1 WHERE true")}
+        END;
+    """)
+    # the snapshot repeats item and merchant names on every purchase
+    for table, key, columns in (('items', 'item_id', 'description, user_descr, category'),
+                                ('merchants', 'merchant_id', 'ocr_name, name')):
+        months = f"""
+            SELECT DISTINCT substr(t.trip_datetime, 1, 7), 1
+            FROM purchases p
+                inner join receipts t on
+                    t.receipt_id = p.receipt_id
+            WHERE p.{key} = new.{key}"""
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_month_update
+            AFTER UPDATE OF {columns} ON {table}
+            BEGIN {_bump_months(months)} END;
+        """)
+    cur.execute('''
+        INSERT OR IGNORE INTO month_watermark
+        SELECT DISTINCT substr(trip_datetime, 1, 7), 1 FROM receipts
+    ''')
+
+# (version, description, upgrade function) in the order they are applied
+MIGRATIONS = [
+    (1, 'create the tables', _create_tables),
+    (2, 'unique (merchant_id, description) index on items', _unique_items),
+    (3, 'indexes for reporting, fix update_date_trigger', _report_indexes),
+    (4, 'daily and monthly spend rollups', _spend_rollups),
+    (5, 'ingest watermark for report caching', _watermark),
+    (6, 'fix swapped shared_payments, track dirty receipts', _dirty_receipts),
+    (7, 'ingest journal of loaded files', _ingest_journal),
+    (8, 'full-text index over item descriptions', _items_fts),
+    (9, 'item categories', _item_categories),
+    (10, 'perceptual hashes of ocr images', _image_hashes),
+    (11, 'price history per item and trip', _price_history),
+    (12, 'change counter per month for snapshots', _month_watermark),
+    (13, 'move rollups when a receipt changes date', _rollup_trip_moves),
+    (14, 'move price history when a receipt changes date', _price_trip_moves),
+    (15, 'drop image hashes taken before photos were straightened', _rehash_images),
+]
+
+def schema_version(con):
+    return con.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(con, target=None):
+    """
+        brings the database up to target (default latest), one transaction
+        per migration. Returns the version the database ends up at
+    """
+    for version, description, upgrade in MIGRATIONS:
+        if version <= schema_version(con):
+            continue
+        if target is not None and version > target:
+            break
+        print(f'Migrating to version {version}: {description}')
+        cur = con.cursor()
+        cur.execute('BEGIN')
+        try:
+            upgrade(cur)
+            cur.execute(f'PRAGMA user_version = {version}')
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+    return schema_version(con)
+
+SQL_WORDS = {'where', 'inner', 'left', 'join', 'on', 'group', 'order', 'limit', 'set'}
+
+def table_scans(con, sql, params=(), table='purchases'):
+    """
+        returns the EXPLAIN QUERY PLAN lines that read every row of table,
+        either directly or through a full walk of one of its indexes
+    """
+    names = {table}
+    for alias in re.findall(rf'\b{table}\s+(?:as\s+)?(\w+)', sql, re.IGNORECASE):
+        if alias.lower() not in SQL_WORDS:
+            names.add(alias)
+    plan = con.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+    return [detail for *_, detail in plan
+            if re.match(r'SCAN (\w+)', detail) and detail.split()[1] in names]
+
+def check_query_plans(con, queries, table='purchases'):
+    """
+        queries maps a name to (sql, params). Prints the plan check for each
+        and returns the names of the queries that scan table
+    """
+    bad = []
+    for name, (sql, params) in queries.items():
+        scans = table_scans(con, sql, params, table)
+        print(f"{name}: {'SCANS ' + table if scans else 'ok'} {scans if scans else ''}")
+        if scans:
+            bad.append(name)
+    return bad
+
+def add_arguments(parser):
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--target', type=int, default=None)
+    parser.add_argument('--check', action='store_true',
+                        help='fail if a reporting query scans purchases')
+
+def run(args):
+    with instrument.connect(args.db) as con:
+        print(f'Schema at version {migrate(con, args.target)}')
+        if args.check:
+            from database_manager import REPORT_QUERIES
+            if check_query_plans(con, REPORT_QUERIES):
+                raise SystemExit(1)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Upgrade the database schema in place')
+    add_arguments(parser)
+    run(parser.parse_args())
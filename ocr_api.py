@@ -1,49 +1,324 @@
 import requests
 import json
-from time import sleep
+import glob
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import sleep, monotonic, time
+
+import dedup
+import instrument
+import ocr_cache
+import preprocess
 
 # Limited to about 5 calls per day with 'TEST' key
 url = "https://ocr.asprise.com/api/v1/receipt"
+API_KEY = 'TEST'
+RECOGNIZER = 'auto'
+REF_NO = 'ocr_python_xyz'
+TIMEOUT = 10 # will timeout after 10 seconds
+MAX_RETRIES = 3
+BACKOFF_BASE = 2 # seconds, doubled on every retry
+BACKOFF_CAP = 60
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.pdf')
+BUDGET_FILE = 'ocr_calls.json' # remembers calls made in the last 24h
+
+# status codes worth trying again
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class DailyLimitReached(Exception):
+    pass
+
+class RateLimiter:
+    """
+        spaces calls out to at most per_second and stops after per_day calls
+        in a rolling 24h window. The daily count is kept in state_file so it
+        survives between runs.
+    """
+    def __init__(self, per_second=1.0, per_day=5, state_file=BUDGET_FILE):
+        self.interval = 1.0 / per_second if per_second else 0
+        self.per_day = per_day
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.next_call = monotonic()
+        self.calls = self._load()
+
+    def _load(self):
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return []
+        with open(self.state_file) as f:
+            calls = json.load(f)
+        return [t for t in calls if t > time() - 86400]
+
+    def _save(self):
+        if self.state_file is None:
+            return
+        with open(self.state_file, 'w') as f:
+            json.dump(self.calls, f)
+
+    def remaining(self):
+        if self.per_day is None:
+            return None
+        with self.lock:
+            self.calls = [t for t in self.calls if t > time() - 86400]
+            return self.per_day - len(self.calls)
 
-def get_results(image_path):
+    def acquire(self):
+        with self.lock:
+            if self.per_day is not None:
+                self.calls = [t for t in self.calls if t > time() - 86400]
+                if len(self.calls) >= self.per_day:
+                    raise DailyLimitReached(f'Used {len(self.calls)} of {self.per_day} calls today')
+                self.calls.append(time())
+                self._save()
+            wait = self.next_call - monotonic()
+            self.next_call = max(self.next_call, monotonic()) + self.interval
+        if wait > 0:
+            sleep(wait)
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(pool_size=10):
+    # one shared session so keep-alive connections are reused between calls
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=pool_size)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
+
+def backoff_delay(attempt):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+def read_image(image_path):
+    with open(image_path, 'rb') as f:
+        return f.read()
+
+def upload_name(image_path, image):
+    # a preprocessed image is a jpeg whatever the original was
+    name = os.path.basename(image_path)
+    if image[:3] == b'\xff\xd8\xff':
+        name = os.path.splitext(name)[0] + '.jpg'
+    return name
+
+def get_results(image_path, session=None, limiter=None, api_url=None,
+                max_retries=MAX_RETRIES, image=None):
+    session = session or get_session()
+    api_url = api_url or url
+    if image is None:
+        image = read_image(image_path)
+    filename = upload_name(image_path, image)
     def post():
-        res = requests.post(url,
-                            data = {
-                                'api_key':'TEST',
-                                'recognizer':'auto',
-                                'ref_no':'ocr_python_xyz'
-                            },
-                            files = {
-                                'file':open(image_path,'rb')
-                            },
-                            timeout=10) # will timeout after 10 seconds
+        if limiter is not None:
+            with instrument.span('ocr.rate_limit'):
+                limiter.acquire()
+        with instrument.span('ocr.http_post'):
+            res = session.post(api_url,
+                               data = {
+                                   'api_key':API_KEY,
+                                   'recognizer':RECOGNIZER,
+                                   'ref_no':REF_NO
+                               },
+                               files = {
+                                   'file':(filename, image)
+                               },
+                               timeout=TIMEOUT)
         return res
-    try:
-        res = post()
-    except requests.Timeout:
-        print('Timeout. Will wait 10s and try again')
-        sleep(10)
-        res = post()
-    except requests.ConnectionError:
-        print('Could not connect!')
+    for attempt in range(max_retries + 1):
+        try:
+            res = post()
+        except (requests.Timeout, requests.ConnectionError) as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            print(f'{type(e).__name__} on {image_path}. Will wait {delay:.1f}s and try again')
+            with instrument.span('ocr.backoff'):
+                sleep(delay)
+            continue
+        if res.status_code in RETRY_STATUS and attempt < max_retries:
+            delay = backoff_delay(attempt)
+            print(f'Status {res.status_code} on {image_path}. Will wait {delay:.1f}s and try again')
+            with instrument.span('ocr.backoff'):
+                sleep(delay)
+            continue
+        break
     if res.status_code==200:
         print(f"Status Code:{res.status_code}, success!!")
     else:
         print(f"Bad status code: {res.status_code}")
     return res
 
+def get_json(image_path, use_cache=True, shrinker=None, deduplicator=None, **kwargs):
+    """
+        returns the parsed api response for an image, served from the
+        ocr cache when the same image bytes were already recognized.
+        use_cache=False skips the lookup but still refreshes the cache.
+        shrinker (a preprocess.Shrinker) makes the upload smaller first.
+        deduplicator (a dedup.Deduplicator) raises dedup.DuplicateImage
+        instead of calling the api for another photo of a known receipt
+    """
+    with instrument.span('ocr.read_image'):
+        image = read_image(image_path)
+    params = {'recognizer':RECOGNIZER}
+    if shrinker is not None:
+        params['preprocess'] = shrinker.settings
+    with instrument.span('ocr.cache_lookup'):
+        key = ocr_cache.cache_key(image, params)
+        text = ocr_cache.get(key) if use_cache else None
+    if text is not None:
+        print(f'{image_path}: served from cache')
+        return json.loads(text)
+    pending = None
+    if deduplicator is not None:
+        with instrument.span('ocr.dedup'):
+            pending = deduplicator.check(image_path, image)
+    try:
+        if shrinker is not None:
+            with instrument.span('ocr.preprocess'):
+                image = shrinker(image, image_path)
+        res = get_results(image_path, image=image, **kwargs)
+        if res.status_code != 200:
+            raise ValueError(f'Bad status code {res.status_code} for {image_path}')
+        with instrument.span('ocr.parse_json'):
+            jobj = json.loads(res.text)
+    except BaseException:
+        # timeouts, DailyLimitReached, bad statuses: the photo wasn't OCRed
+        if pending is not None:
+            deduplicator.forget(pending)
+        raise
+    if pending is not None:
+        deduplicator.confirm(pending)
+    # only keep responses the provider says were recognized
+    if jobj.get('success', True):
+        with instrument.span('ocr.cache_store'):
+            ocr_cache.put(key, res.text)
+    return jobj
+
+def json_path(filename):
+    name = os.path.splitext(os.path.basename(filename))[0] # remove the extension
+    return f'json/{name}.json'
+
 def write_json(jobj, filename):
-    filename = filename.split('.')[0] # remove the extension
-    with open(f'json/{filename}.json', 'w', encoding='utf-8') as f:
-        json.dump(jobj, f, ensure_ascii=False, indent=4)
-    
-     
-def main(img_path=None):
+    path = json_path(filename)
+    with instrument.span('ocr.write_json'):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temp file first so a crash never leaves half a json behind
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(jobj, f, ensure_ascii=False, indent=4)
+        os.replace(path + '.tmp', path)
+
+def find_images(pattern):
+    # pattern can be a folder or a glob like receipts/*.jpg
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*')
+    return sorted(p for p in glob.glob(pattern)
+                  if p.lower().endswith(IMAGE_EXTENSIONS))
+
+def batch(pattern, workers=4, per_second=1.0, per_day=5, api_url=None,
+          skip_existing=True, state_file=BUDGET_FILE, use_cache=True, shrinker=None,
+          deduplicator=None):
+    """
+        OCR every image matching pattern using a bounded thread pool.
+        Each json/<name>.json is written as soon as its response arrives.
+        Returns a dict of image path -> 'ok', 'skipped', 'limit',
+        'duplicate' or an error
+    """
+    images = find_images(pattern)
+    if skip_existing:
+        todo = [p for p in images if not os.path.exists(json_path(p))]
+    else:
+        todo = images
+    status = {p:'skipped' for p in images if p not in todo}
+    limiter = RateLimiter(per_second, per_day, state_file)
+    session = get_session(pool_size=workers)
+    print(f'{len(todo)} of {len(images)} images to OCR, {workers} workers')
+
+    def work(image_path):
+        jobj = get_json(image_path, use_cache=use_cache, shrinker=shrinker,
+                        deduplicator=deduplicator, session=session, limiter=limiter,
+                        api_url=api_url)
+        write_json(jobj, image_path)
+        return 'ok'
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(work, p):p for p in todo}
+        for future in as_completed(futures):
+            image_path = futures[future]
+            try:
+                status[image_path] = future.result()
+            except DailyLimitReached as e:
+                status[image_path] = 'limit'
+                print(f'{image_path}: {e}')
+            except dedup.DuplicateImage as e:
+                status[image_path] = 'duplicate'
+                print(e)
+            except Exception as e:
+                status[image_path] = repr(e)
+                print(f'{image_path}: failed with {e!r}')
+            else:
+                print(f'{image_path}: {status[image_path]}')
+    done = sum(1 for s in status.values() if s == 'ok')
+    ocr_cache.evict()
+    if shrinker is not None:
+        print(shrinker.summary())
+    duplicates = sum(1 for s in status.values() if s == 'duplicate')
+    print(f'Finished batch: {done} written, {len(images) - len(todo)} skipped, '
+          f'{duplicates} duplicate photos, {len(todo) - done - duplicates} not written')
+    return status
+
+def main(img_path=None, use_cache=True, shrinker=None, deduplicator=None,
+         per_second=1.0, per_day=5, api_url=None, state_file=BUDGET_FILE):
     if img_path == None:
         img_path = input('Enter the receipt pic filename:\n')
-    res = get_results(img_path)
-    jobj = json.loads(res.text)
+    # counted in state_file like a batch, so the daily budget sees this call too
+    limiter = RateLimiter(per_second, per_day, state_file)
+    jobj = get_json(img_path, use_cache=use_cache, shrinker=shrinker,
+                    deduplicator=deduplicator, limiter=limiter, api_url=api_url)
     write_json(jobj, img_path)
-    
+    return json_path(img_path)
+
+def add_arguments(parser):
+    parser.add_argument('images', nargs='?',
+                        help='a folder or glob of images to OCR in one batch')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--per-second', type=float, default=1.0)
+    parser.add_argument('--per-day', type=int, default=5,
+                        help='daily call budget, use 0 for no limit')
+    parser.add_argument('--url', default=None, help='override the api url')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='OCR images that already have a json file')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always call the api, ignoring cached responses')
+    parser.add_argument('--shrink', action='store_true',
+                        help='shrink images before uploading, see preprocess.py')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='OCR photos even when they look like a receipt already sent')
+    parser.add_argument('--dedup-distance', type=int, default=dedup.MAX_DISTANCE,
+                        help='bits of the perceptual hash two photos of one receipt may differ by')
+    preprocess.add_arguments(parser)
+
+def run(args):
+    shrinker = preprocess.from_args(args) if args.shrink else None
+    deduplicator = None
+    if not args.no_dedup:
+        deduplicator = dedup.open_deduplicator(max_distance=args.dedup_distance)
+    if args.images is None:
+        main(use_cache=not args.no_cache, shrinker=shrinker, deduplicator=deduplicator,
+             per_second=args.per_second, per_day=args.per_day or None, api_url=args.url)
+    else:
+        batch(args.images, workers=args.workers, per_second=args.per_second,
+              per_day=args.per_day or None, api_url=args.url,
+              skip_existing=not args.overwrite, use_cache=not args.no_cache,
+              shrinker=shrinker, deduplicator=deduplicator)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description='OCR receipt images')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import tempfile
+from time import time
+
+# raw api responses live here, one file per image hash
+CACHE_DIR = 'ocr_cache'
+MAX_BYTES = 200 * 1024 * 1024
+MAX_AGE_DAYS = 365
+
+def cache_key(image_bytes, params):
+    """
+        hash of the image bytes plus the recognizer parameters,
+        so a renamed file still hits but a different recognizer does not
+    """
+    h = hashlib.sha256(image_bytes)
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+def _path(key, cache_dir):
+    return os.path.join(cache_dir, key[:2], f'{key}.json')
+
+def get(key, cache_dir=CACHE_DIR):
+    # returns the raw response text or None
+    path = _path(key, cache_dir)
+    try:
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+    except FileNotFoundError:
+        return None
+    os.utime(path) # mark as recently used for eviction
+    return text
+
+def put(key, text, cache_dir=CACHE_DIR):
+    path = _path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def entries(cache_dir=CACHE_DIR):
+    # (path, size, last used) for every cached response
+    out = []
+    if not os.path.isdir(cache_dir):
+        return out
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith('.json'):
+                st = os.stat(os.path.join(root, name))
+                out.append((os.path.join(root, name), st.st_size, st.st_mtime))
+    return out
+
+def evict(max_bytes=MAX_BYTES, max_age_days=MAX_AGE_DAYS, cache_dir=CACHE_DIR):
+    """
+        drops entries older than max_age_days, then the least recently used
+        ones until the cache fits in max_bytes. Returns the number removed
+    """
+    removed = 0
+    kept = []
+    cutoff = time() - max_age_days * 86400 if max_age_days is not None else None
+    for path, size, used in entries(cache_dir):
+        if cutoff is not None and used < cutoff:
+            os.remove(path)
+            removed += 1
+        else:
+            kept.append((path, size, used))
+    if max_bytes is not None:
+        total = sum(size for _, size, _ in kept)
+        for path, size, _ in sorted(kept, key=lambda e: e[2]):
+            if total <= max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+    return removed
+
+def stats(cache_dir=CACHE_DIR):
+    e = entries(cache_dir)
+    return {'entries': len(e), 'bytes': sum(size for _, size, _ in e)}
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Manage the OCR response cache')
+    parser.add_argument('--max-mb', type=float, default=MAX_BYTES / 1024 / 1024)
+    parser.add_argument('--max-age-days', type=float, default=MAX_AGE_DAYS)
+    parser.add_argument('--clear', action='store_true', help='remove everything')
+    args = parser.parse_args()
+    if args.clear:
+        n = evict(max_bytes=0, max_age_days=None)
+    else:
+        n = evict(int(args.max_mb * 1024 * 1024), args.max_age_days)
+    print(f'Removed {n} entries. Cache now: {stats()}')
@@ -0,0 +1,166 @@
+import io
+import os
+import threading
+from time import perf_counter
+
+# Shrinks receipt photos before they are sent to the ocr api. A phone photo
+# is several MB, the api only needs legible text, so a cropped grayscale
+# jpeg of a few hundred KB uploads far faster and times out far less.
+# Pillow is imported when an image is shrunk so ocr_api can offer the
+# options without loading it
+
+MAX_DIMENSION = 2000 # pixels on the longest side
+TARGET_BYTES = 300_000
+MIN_DIMENSION = 800 # never shrink below this to hit TARGET_BYTES
+MIN_QUALITY = 40
+MAX_QUALITY = 90
+CROP_MARGIN = 0.02 # fraction of the image kept around the receipt
+CROP_MIN_AREA = 0.1 # crops smaller than this are probably wrong, skip them
+
+def find_receipt(gray, margin=CROP_MARGIN):
+    """
+        the box around the paper: the brightest large region once the text
+        is blurred away, with margin (a fraction of the image) kept around
+        it. Returns None when nothing clearly stands out
+    """
+    from PIL import ImageFilter
+    small = gray.copy()
+    small.thumbnail((256, 256))
+    small = small.filter(ImageFilter.BoxBlur(3))
+    lo, hi = small.getextrema()
+    if hi - lo < 40:
+        return None # flat image, no paper edge to find
+    threshold = (lo + hi) // 2
+    box = small.point(lambda v: 255 if v > threshold else 0).getbbox()
+    if box is None:
+        return None
+    sx, sy = gray.width / small.width, gray.height / small.height
+    mx, my = gray.width * margin, gray.height * margin
+    left, top, right, bottom = box
+    box = (max(0, int(left * sx - mx)), max(0, int(top * sy - my)),
+           min(gray.width, int(right * sx + mx)), min(gray.height, int(bottom * sy + my)))
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    if area < CROP_MIN_AREA * gray.width * gray.height or area == gray.width * gray.height:
+        return None
+    return box
+
+def to_jpeg(image, quality):
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=quality, optimize=True)
+    return buf.getvalue()
+
+def encode(image, target_bytes):
+    # the highest jpeg quality that fits target_bytes, else the lowest quality
+    best = to_jpeg(image, MIN_QUALITY)
+    if len(best) > target_bytes:
+        return best
+    lo, hi = MIN_QUALITY + 1, MAX_QUALITY
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        data = to_jpeg(image, quality)
+        if len(data) <= target_bytes:
+            best = data
+            lo = quality + 1
+        else:
+            hi = quality - 1
+    return best
+
+def shrink(data, max_dimension=MAX_DIMENSION, target_bytes=TARGET_BYTES,
+           grayscale=True, crop=True):
+    """
+        auto-orients, crops to the receipt, converts to grayscale, caps the
+        longest side and recompresses to about target_bytes.
+        Returns jpeg bytes, or data unchanged when that would not be smaller
+    """
+    from PIL import Image, ImageOps
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (OSError, Image.DecompressionBombError):
+        return data # pdfs and anything else Pillow can't read go up as they are
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('L' if grayscale else 'RGB')
+    if crop:
+        box = find_receipt(image if grayscale else image.convert('L'))
+        if box is not None:
+            image = image.crop(box)
+    if max(image.size) > max_dimension:
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    out = encode(image, target_bytes)
+    # too big even at the lowest quality, trade some resolution for it
+    while len(out) > target_bytes and max(image.size) * 0.75 >= MIN_DIMENSION:
+        image = image.resize((int(image.width * 0.75), int(image.height * 0.75)),
+                             Image.Resampling.LANCZOS)
+        out = encode(image, target_bytes)
+    return out if len(out) < len(data) else data
+
+class Shrinker:
+    """
+        shrink with fixed settings, safe to share between threads.
+        Keeps a running total of bytes saved and time spent
+    """
+    def __init__(self, max_dimension=MAX_DIMENSION, target_bytes=TARGET_BYTES,
+                 grayscale=True, crop=True):
+        self.settings = {'max_dimension':max_dimension, 'target_bytes':target_bytes,
+                         'grayscale':grayscale, 'crop':crop}
+        self.lock = threading.Lock()
+        self.images = 0
+        self.before = 0
+        self.after = 0
+        self.seconds = 0.0
+
+    def __call__(self, data, name=''):
+        start = perf_counter()
+        out = shrink(data, **self.settings)
+        seconds = perf_counter() - start
+        with self.lock:
+            self.images += 1
+            self.before += len(data)
+            self.after += len(out)
+            self.seconds += seconds
+        print(f'{name}: {len(data) / 1024:.0f}KB -> {len(out) / 1024:.0f}KB '
+              f'({1 - len(out) / max(len(data), 1):.0%} smaller) in {seconds:.2f}s')
+        return out
+
+    def summary(self):
+        if not self.images:
+            return 'No images preprocessed'
+        return (f'Preprocessed {self.images} images: {self.before / 2**20:.1f}MB -> '
+                f'{self.after / 2**20:.1f}MB ({1 - self.after / self.before:.0%} smaller) '
+                f'in {self.seconds:.1f}s')
+
+def add_arguments(parser):
+    # the settings flags, also used by ocr_api --shrink
+    parser.add_argument('--max-dimension', type=int, default=MAX_DIMENSION,
+                        help='longest side in pixels after preprocessing')
+    parser.add_argument('--target-kb', type=int, default=TARGET_BYTES // 1000,
+                        help='recompress images to about this size')
+    parser.add_argument('--color', action='store_true',
+                        help='keep color instead of converting to grayscale')
+    parser.add_argument('--no-crop', action='store_true',
+                        help="don't crop to the receipt")
+
+def from_args(args):
+    return Shrinker(args.max_dimension, args.target_kb * 1000,
+                    grayscale=not args.color, crop=not args.no_crop)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Preview preprocessing: write shrunk copies of receipt images')
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--out', default='preprocessed')
+    add_arguments(parser)
+    args = parser.parse_args()
+    shrinker = from_args(args)
+    os.makedirs(args.out, exist_ok=True)
+    for path in args.images:
+        with open(path, 'rb') as f:
+            original = f.read()
+        data = shrinker(original, path)
+        name = os.path.basename(path)
+        if data is not original:
+            name = os.path.splitext(name)[0] + '.jpg'
+        with open(os.path.join(args.out, name), 'wb') as f:
+            f.write(data)
+    print(shrinker.summary())
@@ -0,0 +1,190 @@
+import instrument
+import search
+from migrations import DB_NAME, price_totals_sql
+
+# What items cost over time, read from the price_history table that triggers
+# on purchases keep up to date (see migrations._price_history). It has one
+# row per item and trip, so none of this joins purchases, receipts and items.
+#   python prices.py dog food           history of the matching items
+#   python prices.py --changes          items whose price moved 20% or more
+
+WINDOW = 5 # trips the rolling min, max and median look back over
+THRESHOLD = 20 # percent change --changes reports
+
+def history(con, item_id, start=None, end=None):
+    # [(trip_datetime, unit price, quantity)] of one item, oldest first
+    sql = """
+        select trip_datetime, amount / quantity, quantity
+        from price_history
+        where item_id = :item_id
+    """
+    if start is not None:
+        sql += ' and trip_datetime >= :start'
+    if end is not None:
+        # '~' sorts after every character in a datetime, like reports.build_query
+        sql += ' and trip_datetime <= :end'
+        end += '~'
+    sql += ' order by trip_datetime'
+    return con.execute(sql, {'item_id':item_id, 'start':start, 'end':end}).fetchall()
+
+def latest(con, item_ids=None):
+    # item_id -> (trip_datetime, unit price) from the last trip each item was bought on
+    sql = 'select item_id, max(trip_datetime), amount / quantity from price_history'
+    params = []
+    if item_ids is not None:
+        params = list(item_ids)
+        sql += f" where item_id in ({','.join(['?'] * len(params))})"
+    sql += ' group by item_id'
+    return {item_id: (trip, price) for item_id, trip, price in con.execute(sql, params)}
+
+def summary(con, item_id, window=WINDOW, start=None, end=None):
+    """
+        the price history of one item as a dataframe, with the rolling min,
+        max and median unit price over the last window trips and the percent
+        change from the trip before
+    """
+    import pandas as pd
+    df = pd.DataFrame(history(con, item_id, start, end),
+                      columns=['trip_datetime', 'unit_price', 'quantity'])
+    rolling = df['unit_price'].rolling(window, min_periods=1)
+    df['rolling_min'] = rolling.min()
+    df['rolling_max'] = rolling.max()
+    df['rolling_median'] = rolling.median()
+    df['pct_change'] = df['unit_price'].pct_change() * 100
+    return df
+
+def changes(con, threshold=THRESHOLD, since=None):
+    """
+        every time an item's unit price moved threshold percent or more from
+        the trip before, across the whole catalog. The prices are streamed
+        once in key order into a numpy array and each one is compared with
+        the one before it, so only the items that moved cost any python.
+        since keeps only the moves on or after that date.
+        Returns [(item_id, trip_datetime, old price, new price, pct change)],
+        biggest moves first
+    """
+    import numpy as np
+    with instrument.span('prices.scan'):
+        rows = np.fromiter(con.execute("""
+            select item_id, amount / quantity
+            from price_history
+            order by item_id, trip_datetime
+        """), dtype=[('item_id', np.int64), ('price', float)])
+    item_ids, prices = rows['item_id'], rows['price']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = (prices[1:] / prices[:-1] - 1) * 100
+    moved = ((item_ids[1:] == item_ids[:-1]) & np.isfinite(change)
+             & (np.abs(change) >= threshold))
+    at = np.flatnonzero(moved) + 1 # the row the price moved on
+    at = at[np.argsort(-np.abs(change[at - 1]), kind='stable')]
+    # the trip of a row is its position among the rows of its item
+    first = np.searchsorted(item_ids, item_ids[at])
+    trips = item_trips(con, np.unique(item_ids[at]).tolist())
+    found = [(item_id, trips[item_id][n], float(prices[i - 1]), float(prices[i]),
+              round(float(change[i - 1]), 1))
+             for i, item_id, n in zip(at.tolist(), item_ids[at].tolist(), (at - first).tolist())]
+    if since is not None:
+        found = [row for row in found if row[1] >= since]
+    return found
+
+def item_trips(con, item_ids):
+    # item_id -> the trip_datetimes it has a price for, in order
+    trips = {}
+    for i in range(0, len(item_ids), 500):
+        chunk = item_ids[i:i + 500]
+        for item_id, trip in con.execute(f"""
+            select item_id, trip_datetime
+            from price_history
+            where item_id in ({','.join(['?'] * len(chunk))})
+            order by item_id, trip_datetime
+        """, chunk):
+            trips.setdefault(item_id, []).append(trip)
+    return trips
+
+def descriptions(con, item_ids):
+    # item_id -> (merchant ocr_name, description)
+    found = {}
+    item_ids = list(item_ids)
+    for i in range(0, len(item_ids), 500):
+        chunk = item_ids[i:i + 500]
+        rows = con.execute(f"""
+            select i.item_id, m.ocr_name, i.description
+            from items i
+                inner join merchants m on
+                    m.merchant_id = i.merchant_id
+            where i.item_id in ({','.join(['?'] * len(chunk))})
+        """, chunk)
+        found.update((item_id, (merchant, description)) for item_id, merchant, description in rows)
+    return found
+
+def rebuild(con):
+    # recomputes the price history from purchases in one transaction
+    with con:
+        con.execute('DELETE FROM price_history')
+        con.execute(f'INSERT INTO price_history {price_totals_sql()}')
+
+def check(con, tolerance=0.005):
+    # [(item_id, trip_datetime, stored, expected)] where the history is out of date
+    stored = {row[:2]:row[2:] for row in con.execute('select * from price_history')}
+    expected = {row[:2]:row[2:] for row in con.execute(price_totals_sql())}
+    mismatches = []
+    for k in stored.keys() | expected.keys():
+        s = stored.get(k, (0, 0, 0))
+        e = expected.get(k, (0, 0, 0))
+        if abs(s[0] - e[0]) > tolerance or abs(s[1] - e[1]) > tolerance or s[2] != e[2]:
+            mismatches.append((*k, s, e))
+    return mismatches
+
+def add_arguments(parser):
+    parser.add_argument('text', nargs='*', help='words in the item description')
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--item-id', type=int, action='append', dest='item_ids')
+    parser.add_argument('--start', help='YYYY-MM-DD or any prefix of it')
+    parser.add_argument('--end', help='YYYY-MM-DD or any prefix of it, inclusive')
+    parser.add_argument('--window', type=int, default=WINDOW,
+                        help='trips the rolling min, max and median cover')
+    parser.add_argument('--changes', action='store_true',
+                        help='list every item whose price moved by --threshold or more')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='percent')
+    parser.add_argument('--since', help='with --changes, only moves from this date on')
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--check', action='store_true')
+
+def run(args):
+    con = instrument.connect(args.db)
+    if args.rebuild:
+        rebuild(con)
+        print('Price history rebuilt')
+    if args.check:
+        bad = check(con)
+        for row in bad[:20]:
+            print(row)
+        print(f'{len(bad)} price history rows out of date')
+        if bad:
+            raise SystemExit(1)
+    if args.changes:
+        found = changes(con, args.threshold, args.since)
+        names = descriptions(con, {row[0] for row in found})
+        print('item_id', 'merchant', 'description', 'trip_datetime', 'old', 'new', 'pct_change',
+              sep='\t')
+        for item_id, trip, old, new, pct in found:
+            print(item_id, *names.get(item_id, ('', '')), trip, f'{old:.2f}', f'{new:.2f}',
+                  f'{pct:+.1f}%', sep='\t')
+        print(f'{len(found)} price changes of {args.threshold:g}% or more '
+              f'on {len({row[0] for row in found})} items')
+    item_ids = list(args.item_ids or [])
+    if args.text:
+        item_ids += [row[0] for row in search.items(con, ' '.join(args.text))]
+    names = descriptions(con, item_ids)
+    for item_id in item_ids:
+        merchant, description = names.get(item_id, ('', ''))
+        print(f'\n{item_id} {description} at {merchant}')
+        print(summary(con, item_id, args.window, args.start, args.end)
+              .to_string(index=False, float_format='{:.2f}'.format))
+    con.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Item prices over time')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,217 @@
+import csv
+import json
+from collections import OrderedDict
+
+import instrument
+from migrations import DB_NAME
+
+CHUNKSIZE = 5000
+# results bigger than this are streamed instead of cached
+MAX_CACHED_ROWS = 10000
+MAX_CACHED_QUERIES = 64
+
+# group_by name -> (sql expression, column name)
+GROUPS = {
+    'receipt': ('p.receipt_id', 'receipt_id'),
+    'day': ('substr(r.trip_datetime, 1, 10)', 'day'),
+    'month': ('substr(r.trip_datetime, 1, 7)', 'month'),
+    'merchant': ('m.ocr_name', 'merchant'),
+    'item': ('i.description', 'description'),
+    'category': ('i.category', 'category'),
+    'debtor': ('p.debtor', 'debtor'),
+    'creditor': ('p.creditor', 'creditor'),
+}
+
+DETAIL_COLUMNS = """
+    p.purchase_id,
+    p.receipt_id,
+    r.trip_datetime,
+    m.ocr_name as merchant,
+    i.description,
+    i.category,
+    p.item_cost,
+    p.discount,
+    (p.item_cost + p.discount) as net_cost,
+    p.quantity,
+    p.unit_price,
+    p.debt_multiplier as debt_fraction,
+    p.creditor,
+    p1.name as creditor_name,
+    p.debtor,
+    p2.name as debtor_name
+"""
+
+TOTAL_COLUMNS = """
+    count(*) as purchases,
+    sum(p.item_cost + p.discount) as net_cost,
+    sum((p.item_cost + p.discount) * p.debt_multiplier) as debtor_share
+"""
+
+def build_query(start=None, end=None, merchants=None, participants=None,
+                group_by=None, match=None):
+    """
+        sql and params for purchases between start and end (inclusive,
+        any prefix of 'YYYY-MM-DD HH:MM:SS'), at the given merchants (ocr
+        names) and involving the given participant ids as debtor or creditor.
+        match is an fts5 query on the item descriptions (see search.py).
+        group_by is None for one row per purchase or a list of GROUPS keys
+    """
+    where = []
+    params = {}
+    if start is not None:
+        where.append('r.trip_datetime >= :start')
+        params['start'] = start
+    if end is not None:
+        # '~' sorts after every character in a datetime so a date
+        # prefix includes the whole day and the receipts index still applies
+        where.append('r.trip_datetime <= :end')
+        params['end'] = end + '~'
+    if merchants:
+        names = {f'merchant{n}':m for n, m in enumerate(merchants)}
+        where.append(f"m.ocr_name in ({','.join(':' + k for k in names)})")
+        params.update(names)
+    if participants:
+        ids = {f'participant{n}':int(x) for n, x in enumerate(participants)}
+        keys = ','.join(':' + k for k in ids)
+        where.append(f'(p.debtor in ({keys}) or p.creditor in ({keys}))')
+        params.update(ids)
+    if match is not None:
+        # the full-text index finds the items, purchases_item their purchases
+        where.append('p.item_id in (select rowid from items_fts where items_fts match :match)')
+        params['match'] = match
+
+    if group_by:
+        groups = [GROUPS[g] for g in group_by]
+        select = ',\n    '.join(f'{expr} as {name}' for expr, name in groups)
+        select += ',' + TOTAL_COLUMNS
+    else:
+        select = DETAIL_COLUMNS
+    sql = f"""
+        select {select}
+        from receipts r
+            inner join purchases p on
+                p.receipt_id = r.receipt_id
+            left join merchants m on
+                p.merchant_id = m.merchant_id
+            left join items i on
+                p.item_id = i.item_id
+            left join participants p1 on
+                p.creditor = p1.participant_id
+            left join participants p2 on
+                p.debtor = p2.participant_id
+    """
+    if where:
+        sql += '    where ' + '\n        and '.join(where)
+    if group_by:
+        sql += f"\n    group by {', '.join(expr for expr, _ in groups)}"
+        sql += f"\n    order by {', '.join(expr for expr, _ in groups)}"
+    else:
+        sql += '\n    order by r.trip_datetime, p.purchase_id'
+    return sql, params
+
+def stream(con, chunksize=CHUNKSIZE, **filters):
+    """
+        returns (columns, chunks) where chunks generates lists of at most
+        chunksize row tuples, so memory stays flat however large the range
+    """
+    sql, params = build_query(**filters)
+    cur = con.execute(sql, params)
+    columns = [d[0] for d in cur.description]
+    def chunks():
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if not rows:
+                break
+            yield rows
+    return columns, chunks()
+
+def ingest_watermark(con):
+    row = con.execute("select value from watermark where name = 'ingest'").fetchone()
+    return row[0] if row else None
+
+# (db, sql, params) -> (watermark, columns, rows)
+_cache = OrderedDict()
+
+def query(con, use_cache=True, **filters):
+    """
+        returns (columns, rows) for a report. Results are kept in memory and
+        reused until the ingest watermark moves
+    """
+    sql, params = build_query(**filters)
+    db = con.execute('PRAGMA database_list').fetchone()[2]
+    key = (db, sql, tuple(sorted(params.items())))
+    mark = ingest_watermark(con)
+    if use_cache and key in _cache and _cache[key][0] == mark:
+        _cache.move_to_end(key)
+        return _cache[key][1:]
+    cur = con.execute(sql, params)
+    columns = [d[0] for d in cur.description]
+    rows = cur.fetchall()
+    if use_cache and mark is not None and len(rows) <= MAX_CACHED_ROWS:
+        _cache[key] = (mark, columns, rows)
+        while len(_cache) > MAX_CACHED_QUERIES:
+            _cache.popitem(last=False)
+    return columns, rows
+
+def report(con, **filters):
+    # the same as query but as a pandas dataframe
+    import pandas as pd
+    columns, rows = query(con, **filters)
+    return pd.DataFrame(rows, columns=columns)
+
+def export(con, path, fmt='csv', chunksize=CHUNKSIZE, **filters):
+    """
+        writes a report to csv or json one chunk at a time.
+        Returns the number of rows written
+    """
+    columns, chunks = stream(con, chunksize, **filters)
+    n = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for rows in chunks:
+                writer.writerows(rows)
+                n += len(rows)
+        elif fmt == 'json':
+            f.write('[')
+            for rows in chunks:
+                for row in rows:
+                    f.write(',\n' if n else '\n')
+                    json.dump(dict(zip(columns, row)), f, ensure_ascii=False)
+                    n += 1
+            f.write('\n]\n')
+        else:
+            raise ValueError(f'Unknown export format {fmt}')
+    return n
+
+def add_arguments(parser):
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--start', help='YYYY-MM-DD or any prefix of it')
+    parser.add_argument('--end', help='YYYY-MM-DD or any prefix of it, inclusive')
+    parser.add_argument('--merchant', action='append', dest='merchants')
+    parser.add_argument('--participant', action='append', type=int, dest='participants')
+    parser.add_argument('--group-by', action='append', choices=list(GROUPS))
+    parser.add_argument('--export', help='write to this file instead of printing')
+    parser.add_argument('--format', default='csv', choices=['csv', 'json'])
+
+def run(args):
+    filters = {'start':args.start, 'end':args.end, 'merchants':args.merchants,
+               'participants':args.participants, 'group_by':args.group_by}
+    con = instrument.connect(args.db)
+    if args.export:
+        n = export(con, args.export, args.format, **filters)
+        print(f'Wrote {n} rows to {args.export}')
+    else:
+        columns, chunks = stream(con, **filters)
+        print(*columns, sep='\t')
+        for rows in chunks:
+            for row in rows:
+                print(*row, sep='\t')
+    con.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Report on purchases')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,93 @@
+import sqlite3
+
+from migrations import DB_NAME, ROLLUPS, rollup_totals_sql
+
+# the spend_daily and spend_monthly tables are kept up to date by triggers on
+# purchases (see migrations._spend_rollups). These helpers read, rebuild and
+# check them
+
+GRAINS = {'day': 'spend_daily', 'month': 'spend_monthly'}
+
+def spend(con, dimension='merchant', grain='month', start=None, end=None, key=None):
+    """
+        rows of (period, key, amount, purchases) for one dimension
+        (merchant, item, participant or category). start and end are
+        inclusive periods like '2023-01' or '2023-01-31'. category adds up
+        the item rows by items.category, so it needs no rebuild when the
+        categories change
+    """
+    table = GRAINS[grain]
+    source, key_sql = table, 'key'
+    if dimension == 'category':
+        source = f'{table} left join items i on i.item_id = {table}.key'
+        key_sql = "coalesce(i.category, '')"
+    sql = f"""
+        select {grain}, {key_sql}, sum(amount), sum(purchases)
+        from {source}
+        where dimension = :dimension
+    """
+    params = {'dimension':'item' if dimension == 'category' else dimension,
+              'start':start, 'end':end, 'key':key}
+    if start is not None:
+        sql += f' and {grain} >= :start'
+    if end is not None:
+        sql += f' and {grain} <= :end'
+    if key is not None:
+        sql += f' and {key_sql} = :key'
+    sql += f' group by {grain}, {key_sql} order by {grain}, {key_sql}'
+    return con.execute(sql, params).fetchall()
+
+def rebuild(con):
+    # recomputes both rollups from purchases in one transaction
+    with con:
+        for table, period, length in ROLLUPS:
+            con.execute(f'DELETE FROM {table}')
+            con.execute(f"""
+                INSERT INTO {table} ({period}, dimension, key, amount, purchases)
+                {rollup_totals_sql(length)}
+            """)
+
+def check(con, tolerance=0.005):
+    """
+        compares the rollups against a fresh aggregate of purchases.
+        Returns a list of (table, period, dimension, key, stored, expected)
+    """
+    mismatches = []
+    for table, period, length in ROLLUPS:
+        stored = {row[:3]:row[3:] for row in con.execute(
+            f'select {period}, dimension, key, amount, purchases from {table}')}
+        expected = {row[:3]:row[3:] for row in con.execute(rollup_totals_sql(length))}
+        for k in stored.keys() | expected.keys():
+            s = stored.get(k, (0, 0))
+            e = expected.get(k, (0, 0))
+            if abs(s[0] - e[0]) > tolerance or s[1] != e[1]:
+                mismatches.append((table, *k, s, e))
+    return mismatches
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Spend rollups')
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--check', action='store_true')
+    parser.add_argument('--dimension', default='merchant',
+                        choices=['merchant', 'item', 'participant', 'category'])
+    parser.add_argument('--grain', default='month', choices=list(GRAINS))
+    parser.add_argument('--start')
+    parser.add_argument('--end')
+    args = parser.parse_args()
+    con = sqlite3.connect(args.db)
+    if args.rebuild:
+        rebuild(con)
+        print('Rollups rebuilt')
+    if args.check:
+        bad = check(con)
+        for row in bad[:20]:
+            print(row)
+        print(f'{len(bad)} rollup rows out of date')
+        if bad:
+            raise SystemExit(1)
+    if not args.rebuild and not args.check:
+        for row in spend(con, args.dimension, args.grain, args.start, args.end):
+            print(*row, sep='\t')
+    con.close()
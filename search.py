@@ -0,0 +1,94 @@
+import instrument
+import reports
+from migrations import DB_NAME
+
+# Finds purchases by what was bought ("how much did we spend on dog food")
+# through the items_fts full-text index, see migrations._items_fts.
+#   python search.py dog food --start 2023-01
+
+MIN_TERM = 3 # the trigram index can't look up anything shorter
+
+def match_query(text):
+    """
+        the fts5 query for text. Every word has to appear in the description
+        or user description, in any order and as any part of a word. Words
+        shorter than MIN_TERM are left out
+    """
+    terms = [t for t in text.split() if len(t) >= MIN_TERM]
+    if not terms:
+        raise ValueError(f'Search for at least one word of {MIN_TERM} or more characters')
+    return ' AND '.join('"' + t.replace('"', '""') + '"' for t in terms)
+
+def items(con, text, limit=None):
+    # (item_id, merchant_id, description, user_descr) of the matching items.
+    # Sorting by relevance (order by rank) scores every match, so they come
+    # back in item_id order, which the index walks for free
+    sql = """
+        select i.item_id, i.merchant_id, i.description, i.user_descr
+        from items_fts f
+            inner join items i on
+                i.item_id = f.rowid
+        where items_fts match ?
+    """
+    params = [match_query(text)]
+    if limit is not None:
+        sql += '    limit ?'
+        params.append(limit)
+    return con.execute(sql, params).fetchall()
+
+def totals(columns, rows):
+    # purchases, net cost and debtor share of a detail or grouped result
+    data = dict(zip(columns, zip(*rows))) if rows else {}
+    number = lambda values: [v or 0 for v in values]
+    net_cost = number(data.get('net_cost', ()))
+    if 'purchases' in columns:
+        purchases = sum(data.get('purchases', ()))
+        debtor_share = sum(number(data.get('debtor_share', ())))
+    else:
+        purchases = len(rows)
+        debtor_share = sum(n * f for n, f in zip(net_cost, number(data.get('debt_fraction', ()))))
+    return {'purchases': purchases, 'net_cost': round(sum(net_cost), 2),
+            'debtor_share': round(debtor_share, 2)}
+
+def search(con, text, use_cache=True, **filters):
+    """
+        the purchases of items matching text, filtered like reports.query.
+        Returns (columns, rows, totals)
+    """
+    columns, rows = reports.query(con, use_cache, match=match_query(text), **filters)
+    return columns, rows, totals(columns, rows)
+
+def add_arguments(parser):
+    parser.add_argument('text', nargs='+', help='words in the item description')
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--start', help='YYYY-MM-DD or any prefix of it')
+    parser.add_argument('--end', help='YYYY-MM-DD or any prefix of it, inclusive')
+    parser.add_argument('--merchant', action='append', dest='merchants')
+    parser.add_argument('--participant', action='append', type=int, dest='participants')
+    parser.add_argument('--group-by', action='append', choices=list(reports.GROUPS))
+    parser.add_argument('--items', action='store_true',
+                        help='list the matching items instead of their purchases')
+
+def run(args):
+    text = ' '.join(args.text)
+    con = instrument.connect(args.db)
+    if args.items:
+        for row in items(con, text):
+            print(*row, sep='\t')
+    else:
+        columns, rows, total = search(con, text, start=args.start, end=args.end,
+                                      merchants=args.merchants,
+                                      participants=args.participants,
+                                      group_by=args.group_by)
+        print(*columns, sep='\t')
+        for row in rows:
+            print(*row, sep='\t')
+        print(f"{total['purchases']} purchases, net cost {total['net_cost']:.2f}, "
+              f"debtor share {total['debtor_share']:.2f}")
+    con.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Search purchases by item description')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,136 @@
+import heapq
+
+import instrument
+from migrations import DB_NAME
+
+# Settles shared costs between any number of participants.
+# Every purchase where debtor != creditor means the debtor owes the creditor
+# (item_cost + discount) * debt_multiplier. shared_payments holds those
+# amounts per receipt and (debtor, creditor) pair; rows already marked paid
+# are never touched.
+
+# the unpaid shared_payments of the dirty receipts, rebuilt from purchases
+RECALCULATE_SQL = """
+    INSERT INTO shared_payments (receipt_id, debtor, creditor, amount_owed, is_paid)
+    SELECT p.receipt_id, p.debtor, p.creditor,
+           round(sum((p.item_cost + coalesce(p.discount, 0)) * coalesce(p.debt_multiplier, 1)), 2),
+           0
+    FROM dirty_receipts d
+        -- cross join keeps dirty_receipts as the outer loop so only
+        -- their purchases are read, through purchases_receipt
+        cross join purchases p on
+            p.receipt_id = d.receipt_id
+    WHERE p.debtor != p.creditor
+        and not exists (
+            SELECT 1
+            FROM shared_payments s
+            WHERE s.receipt_id = p.receipt_id
+                and s.debtor = p.debtor
+                and s.creditor = p.creditor
+                and s.is_paid = 1
+        )
+    GROUP BY p.receipt_id, p.debtor, p.creditor
+"""
+
+BALANCES_SQL = """
+    select participant, round(sum(amount), 2)
+    from (
+        select creditor as participant, amount_owed as amount
+        from shared_payments
+        where is_paid = 0
+        union all
+        select debtor, -amount_owed
+        from shared_payments
+        where is_paid = 0
+    )
+    group by participant
+"""
+
+def recalculate(con, receipt_ids=None):
+    """
+        rebuilds the unpaid shared_payments of every dirty receipt (or of
+        receipt_ids) in one pass. Runs inside the caller's transaction.
+        Returns the number of receipts recalculated
+    """
+    with instrument.span('settlement.recalculate'):
+        if receipt_ids is not None:
+            con.executemany('INSERT OR IGNORE INTO dirty_receipts VALUES (?)',
+                            [(int(r),) for r in receipt_ids])
+        n = con.execute('select count(*) from dirty_receipts').fetchone()[0]
+        if n == 0:
+            return 0
+        con.execute("""
+            DELETE FROM shared_payments
+            WHERE is_paid = 0
+                and receipt_id in (select receipt_id from dirty_receipts)
+        """)
+        con.execute(RECALCULATE_SQL)
+        con.execute('DELETE FROM dirty_receipts')
+    return n
+
+def balances(con):
+    """
+        participant_id -> net amount over all unpaid shared_payments.
+        Positive means the participant is owed money
+    """
+    return {p:b for p, b in con.execute(BALANCES_SQL) if b}
+
+def transfers(balances):
+    """
+        the fewest payments (at most one less than the number of people with
+        a balance) that bring every balance to zero.
+        Returns a list of (debtor, creditor, amount)
+    """
+    owed = [(-amount, p) for p, amount in balances.items() if amount > 0]
+    owing = [(amount, p) for p, amount in balances.items() if amount < 0]
+    heapq.heapify(owed)
+    heapq.heapify(owing)
+    out = []
+    # always match the biggest creditor with the biggest debtor
+    while owed and owing:
+        credit, creditor = heapq.heappop(owed)
+        debt, debtor = heapq.heappop(owing)
+        amount = round(min(-credit, -debt), 2)
+        if amount > 0:
+            out.append((debtor, creditor, amount))
+        if round(-credit - amount, 2) > 0:
+            heapq.heappush(owed, (credit + amount, creditor))
+        if round(-debt - amount, 2) > 0:
+            heapq.heappush(owing, (debt + amount, debtor))
+    return out
+
+def mark_paid(con):
+    # everything outstanding has been settled with the transfers
+    con.execute('UPDATE shared_payments SET is_paid = 1 WHERE is_paid = 0')
+
+def participant_names(con):
+    return dict(con.execute('select participant_id, name from participants'))
+
+def add_arguments(parser):
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--paid', action='store_true',
+                        help='mark every outstanding shared payment as paid')
+
+def run(args):
+    con = instrument.connect(args.db)
+    with con:
+        n = recalculate(con)
+    print(f'Recalculated {n} receipts')
+    names = participant_names(con)
+    name = lambda p: names.get(p) or f'participant {p}'
+    b = balances(con)
+    for p, amount in sorted(b.items()):
+        print(f'{name(p)}: {amount:+.2f}')
+    for debtor, creditor, amount in transfers(b):
+        print(f'{name(debtor)} pays {name(creditor)} {amount:.2f}')
+    if args.paid:
+        with con:
+            mark_paid(con)
+        print('Marked as paid')
+    con.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Work out who owes whom')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,183 @@
+import json
+import os
+from time import perf_counter
+
+import instrument
+from migrations import DB_NAME
+
+# Writes purchases, one row each with its trip, merchant and item, as one
+# columnar file per month of trips, so notebooks can load them without
+# touching the live database:
+#   python snapshot.py --out snapshot
+#   snapshot.load('snapshot', columns=['month', 'category', 'net_cents'], start='2023-01')
+# Money is in integer cents. month_watermark counts the changes to each month
+# (see migrations._month_watermark) and the manifest keeps the counts the
+# files were written at, so an export only rewrites the months that changed.
+# Needs pyarrow, which is imported only to write or read a snapshot.
+
+SNAPSHOT_DIR = 'snapshot'
+MANIFEST = 'manifest.json'
+LAYOUT = 1 # bump when COLUMNS change, older snapshots are then rewritten
+# feather files are written uncompressed so load() can memory-map them
+FORMATS = {'feather': '.arrow', 'parquet': '.parquet'}
+
+_cents = lambda sql: f'cast(round(coalesce({sql}, 0) * 100) AS INTEGER)'
+NET_CENTS = f"({_cents('p.item_cost')} + {_cents('p.discount')})"
+
+# (column, arrow type, sql)
+COLUMNS = (
+    ('purchase_id', 'int64', 'p.purchase_id'),
+    ('receipt_id', 'int64', 'p.receipt_id'),
+    ('trip_datetime', 'string', 't.trip_datetime'),
+    ('month', 'string', 'substr(t.trip_datetime, 1, 7)'),
+    ('merchant_id', 'int64', 'p.merchant_id'),
+    ('merchant', 'string', 'm.ocr_name'),
+    ('item_id', 'int64', 'p.item_id'),
+    ('description', 'string', 'i.description'),
+    ('user_descr', 'string', 'i.user_descr'),
+    ('category', 'string', 'i.category'),
+    ('quantity', 'float64', 'cast(p.quantity AS REAL)'),
+    ('unit_price_cents', 'int64', 'cast(round(p.unit_price * 100) AS INTEGER)'),
+    ('item_cost_cents', 'int64', _cents('p.item_cost')),
+    ('discount_cents', 'int64', _cents('p.discount')),
+    ('net_cents', 'int64', NET_CENTS),
+    ('creditor', 'int64', 'p.creditor'),
+    ('debtor', 'int64', 'p.debtor'),
+    ('debt_multiplier', 'float64', 'p.debt_multiplier'),
+    ('debtor_share_cents', 'int64',
+     f'cast(round({NET_CENTS} * coalesce(p.debt_multiplier, 1)) AS INTEGER)'),
+)
+
+MONTH_SQL = f"""
+    select {', '.join(sql for _, _, sql in COLUMNS)}
+    from receipts t
+        inner join purchases p on
+            p.receipt_id = t.receipt_id
+        left join merchants m on
+            m.merchant_id = p.merchant_id
+        left join items i on
+            i.item_id = p.item_id
+    where t.trip_datetime >= :start and t.trip_datetime <= :end
+    order by p.purchase_id
+"""
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('snapshots need pyarrow: conda install pyarrow') from None
+    return pyarrow
+
+def _table(pa, rows):
+    columns = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+    return pa.table({name: pa.array(values, type=getattr(pa, kind)())
+                     for (name, kind, _), values in zip(COLUMNS, columns)})
+
+def _write(table, path, fmt):
+    # to a temporary file first, so a reader never sees half a month
+    tmp = path + '.tmp'
+    if fmt == 'feather':
+        from pyarrow import feather
+        feather.write_feather(table, tmp, compression='uncompressed')
+    else:
+        import pyarrow.parquet as pq
+        pq.write_table(table, tmp)
+    os.replace(tmp, path)
+
+def read_manifest(folder=SNAPSHOT_DIR):
+    try:
+        with open(os.path.join(folder, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def export(con, out=SNAPSHOT_DIR, fmt='feather', full=False):
+    """
+        brings the snapshot in out up to date, rewriting only the months
+        whose counter moved since the last export (every month with full or
+        a new format). Everything is read in one transaction, so the files
+        match one moment of the database while receipts keep loading.
+        Returns (months written, months unchanged, rows written)
+    """
+    pa = _pyarrow()
+    os.makedirs(out, exist_ok=True)
+    manifest = read_manifest(out)
+    if full or manifest.get('layout') != LAYOUT or manifest.get('format') != fmt:
+        for entry in manifest.get('months', {}).values():
+            if entry['file'] and os.path.exists(os.path.join(out, entry['file'])):
+                os.remove(os.path.join(out, entry['file']))
+        manifest = {'layout': LAYOUT, 'format': fmt, 'months': {}}
+    months = manifest['months']
+    written = rows_written = 0
+    con.execute('BEGIN')
+    try:
+        versions = dict(con.execute('select month, value from month_watermark'))
+        for month, version in sorted(versions.items()):
+            if months.get(month, {}).get('version') == version:
+                continue
+            with instrument.span('snapshot.read'):
+                rows = con.execute(MONTH_SQL, {'start': month, 'end': month + '~'}).fetchall()
+            name = f'purchases-{month}{FORMATS[fmt]}' if rows else None
+            with instrument.span('snapshot.write'):
+                if rows:
+                    _write(_table(pa, rows), os.path.join(out, name), fmt)
+                elif months.get(month, {}).get('file'):
+                    # every purchase of the month is gone
+                    os.remove(os.path.join(out, months[month]['file']))
+            months[month] = {'version': version, 'rows': len(rows), 'file': name}
+            written += 1
+            rows_written += len(rows)
+    finally:
+        con.rollback() # nothing was written, this ends the read
+    tmp = os.path.join(out, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp, os.path.join(out, MANIFEST))
+    return written, len(versions) - written, rows_written
+
+def load(folder=SNAPSHOT_DIR, columns=None, start=None, end=None):
+    """
+        the snapshot as a pyarrow Table, reading only the files of the
+        months from start to end (any prefix of YYYY-MM, inclusive) and only
+        the given columns. Feather files are memory-mapped, so the columns
+        left out are never read from disk. .to_pandas() makes a dataframe
+    """
+    pa = _pyarrow()
+    manifest = read_manifest(folder)
+    tables = []
+    for month, entry in sorted(manifest.get('months', {}).items()):
+        if (not entry['file'] or (start is not None and month < start[:7])
+                or (end is not None and month[:len(end)] > end)):
+            continue
+        path = os.path.join(folder, entry['file'])
+        if manifest['format'] == 'feather':
+            from pyarrow import feather
+            tables.append(feather.read_table(path, columns=columns, memory_map=True))
+        else:
+            import pyarrow.parquet as pq
+            tables.append(pq.read_table(path, columns=columns, memory_map=True))
+    if not tables:
+        table = _table(pa, [])
+        return table.select(columns) if columns else table
+    return pa.concat_tables(tables)
+
+def add_arguments(parser):
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--out', default=SNAPSHOT_DIR)
+    parser.add_argument('--format', default='feather', choices=list(FORMATS),
+                        help='feather loads memory-mapped, parquet is smaller')
+    parser.add_argument('--full', action='store_true', help='rewrite every month')
+
+def run(args):
+    start = perf_counter()
+    con = instrument.connect(args.db)
+    written, unchanged, rows = export(con, args.out, args.format, args.full)
+    con.close()
+    print(f'Wrote {written} months with {rows} purchases to {args.out} in '
+          f'{perf_counter() - start:.2f}s, {unchanged} months unchanged')
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Export purchases as columnar files by month')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,23 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database_manager as dm
+import migrations
+
+@pytest.fixture
+def db(tmp_path, monkeypatch, capsys):
+    # a database migrated to the latest schema, used by the database_manager functions
+    path = str(tmp_path / 'spending_tracker.db')
+    with sqlite3.connect(path) as con:
+        migrations.migrate(con)
+    con.close()
+    monkeypatch.setattr(dm, 'DB_NAME', path)
+    dm.clear_id_caches()
+    capsys.readouterr()
+    yield path
+    dm.clear_id_caches()
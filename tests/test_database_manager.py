@@ -0,0 +1,50 @@
+import database_manager as dm
+
+MERCHANT = (None, 'COSTCO WHOLESALE', '1 Main St', 'Costco', None, None,
+            'Springfield', 'IL', '62701', 'US')
+
+def test_caller_rollback_drops_cached_merchant(db):
+    con = dm.connect(db)
+    assert dm.insert_to_merchants([MERCHANT], con) == [1]
+    con.rollback()
+    assert dm.merchant_cache.get('COSTCO WHOLESALE') is None
+    # inserted again rather than served from the cache
+    assert dm.insert_to_merchants([MERCHANT], con) == [1]
+    con.commit()
+    assert con.execute('select merchant_id, ocr_name from merchants').fetchall() == \
+        [(1, 'COSTCO WHOLESALE')]
+    con.close()
+
+def test_caller_with_block_rollback_drops_cached_merchant(db):
+    con = dm.connect(db)
+    try:
+        with con:
+            dm.insert_to_merchants([MERCHANT], con)
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert dm.merchant_cache.get('COSTCO WHOLESALE') is None
+    assert con.execute('select count(*) from merchants').fetchone() == (0,)
+    con.close()
+
+def test_commit_keeps_cached_merchant(db):
+    con = dm.connect(db)
+    dm.insert_to_merchants([MERCHANT], con)
+    con.commit()
+    con.close()
+    assert dm.merchant_cache.get('COSTCO WHOLESALE') == 1
+
+def test_insert_to_items_on_migrated_schema(db):
+    # items has a category column since migration 9, it is left for categorize.py
+    merchant_id = dm.insert_to_merchants([MERCHANT])[0]
+    dm.insert_to_items([(None, merchant_id, 'KS TOILET PAPER', None)])
+    dm.insert_to_items([{'item_id': None, 'merchant_id': merchant_id,
+                         'description': 'ORGANIC BANANAS', 'user_descr': 'bananas'}])
+    # a known item is skipped
+    dm.insert_to_items([(None, merchant_id, 'KS TOILET PAPER', None)])
+    con = dm.connect(db)
+    assert con.execute('select merchant_id, description, user_descr, category '
+                       'from items order by item_id').fetchall() == \
+        [(merchant_id, 'KS TOILET PAPER', None, None),
+         (merchant_id, 'ORGANIC BANANAS', 'bananas', None)]
+    con.close()
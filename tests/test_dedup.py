@@ -0,0 +1,71 @@
+import io
+import random
+
+import pytest
+
+PIL = pytest.importorskip('PIL')
+from PIL import Image, ImageDraw, ImageFont
+
+import dedup
+
+WORDS = ['MILK', 'EGGS', 'BREAD', 'KS', 'ORGANIC', 'BANANAS', 'CHICKEN', 'RICE',
+         'TOILET', 'PAPER', 'COFFEE', 'YOGURT', 'APPLES', 'OIL', 'DOG', 'FOOD']
+
+def receipt(seed, lines=28):
+    # a receipt from one store, only the items and prices change with seed
+    rng = random.Random(seed)
+    paper = Image.new('L', (300, 100 + 14 * lines), 245)
+    draw = ImageDraw.Draw(paper)
+    font = ImageFont.load_default()
+    draw.text((80, 10), 'COSTCO WHOLESALE', fill=20, font=font)
+    draw.text((70, 24), '1 MAIN ST SPRINGFIELD IL', fill=20, font=font)
+    for n in range(lines):
+        name = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+        draw.text((14, 44 + 14 * n), f'{rng.randint(100000, 999999)} {name}', fill=20, font=font)
+        draw.text((240, 44 + 14 * n), f'{rng.uniform(1, 40):6.2f}', fill=20, font=font)
+    draw.text((14, 54 + 14 * lines), f'TOTAL {rng.uniform(50, 400):8.2f}', fill=20, font=font)
+    return paper.resize((600, paper.height * 2), Image.Resampling.LANCZOS)
+
+def photo(paper, angle=0, scale=1.0, shift=(0, 0), quality=85):
+    # jpeg bytes of the paper lying on a darker table, turned by angle degrees
+    table = Image.effect_noise((1100, 1500), 12).point(lambda v: 60 + v // 8)
+    paper = paper.resize((int(paper.width * scale), int(paper.height * scale)))
+    mask = Image.new('L', paper.size, 255).rotate(angle, expand=True)
+    paper = paper.rotate(angle, expand=True, resample=Image.Resampling.BICUBIC)
+    table.paste(paper, ((table.width - paper.width) // 2 + shift[0],
+                        (table.height - paper.height) // 2 + shift[1]), mask)
+    buf = io.BytesIO()
+    table.convert('RGB').save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+def distance(a, b):
+    return (dedup.image_hash(a) ^ dedup.image_hash(b)).bit_count()
+
+@pytest.fixture(scope='module')
+def first():
+    return photo(receipt(1))
+
+@pytest.mark.parametrize('angle', [-5, -3, 2, 3])
+def test_rotated_retake_is_close(first, angle):
+    retake = photo(receipt(1), angle=angle, scale=0.95, shift=(10, 15))
+    assert distance(first, retake) <= dedup.MAX_DISTANCE
+
+def test_smaller_recompressed_copy_is_close(first):
+    copy = photo(receipt(1), scale=0.8, shift=(30, -20), quality=60)
+    assert distance(first, copy) <= dedup.MAX_DISTANCE
+
+@pytest.mark.parametrize('seed,angle', [(2, 0), (3, 3), (4, -2)])
+def test_other_receipt_from_the_store_is_far(first, seed, angle):
+    assert distance(first, photo(receipt(seed), angle=angle)) > dedup.MAX_DISTANCE
+
+def test_skew_angle_straightens(first):
+    gray = Image.open(io.BytesIO(photo(receipt(1), angle=3))).convert('L')
+    assert dedup.skew_angle(gray) == pytest.approx(-3, abs=0.5)
+
+def test_check_catches_rotated_retake(db, first):
+    dedupe = dedup.Deduplicator(db)
+    dedupe.confirm(dedupe.check('first.jpg', first))
+    with pytest.raises(dedup.DuplicateImage):
+        dedupe.check('retake.jpg', photo(receipt(1), angle=3, scale=0.9))
+    assert dedupe.check('other.jpg', photo(receipt(2), angle=3)) is not None
+    dedupe.close()
@@ -0,0 +1,262 @@
+import json
+import re
+
+import numpy as np
+
+# Turns parsed OCR receipts into insert-ready rows. Everything here is pure
+# python and numpy: no database and no pandas, so a whole batch of receipts
+# goes through in a few columnar passes
+
+# defaults for splitting a trip
+DEFAULT_CREDITOR = 2 # default is my friend with costco card
+DEFAULT_DEBTOR = 1 # default is me
+DEFAULT_DEBT_MULTIPLIER = 0.4 # we agreed on 40%
+SPLIT_COLUMNS = ('creditor', 'debtor', 'debt_multiplier')
+
+# api item field -> purchases column
+ITEM_FIELDS = {
+    'description':'description',
+    'amount':'item_cost',
+    'qty':'quantity',
+    'unitPrice':'unit_price',
+    'flags':'flag',
+    'remarks':'notes',
+}
+
+def parse_merchant(receipt):
+    # list the merchant details
+    return {
+        'merchant_id':None,
+        'ocr_name': receipt['merchant_name'],
+        'address': receipt['merchant_address'],
+        'name':None,
+        'phone': receipt['merchant_phone'],
+        'website': receipt['merchant_website'],
+        'city':receipt['city'],
+        'state':receipt['state'],
+        'zip':receipt['zip'],
+        'country': receipt['country']
+    }
+
+def parse_trip_datetime(receipt):
+    # read the datetime from the receipt
+    date, time = receipt['date'], receipt['time']
+    if not isinstance(date, str) or not isinstance(time, str):
+        raise ValueError(f'Error with date or time from receipt! {date!r} {time!r}')
+    return date + ' ' + time
+
+# the totals are printed at the bottom, so a long receipt has them on its last piece
+TOTAL_FIELDS = ('subtotal', 'tax', 'total')
+
+def stitch(parts):
+    """
+        one receipt from the pieces of a long one, in order. The items are
+        joined, the merchant, date and time come from the first piece that
+        has them and the totals from the last piece that has them
+    """
+    if len(parts) == 1:
+        return parts[0]
+    receipt = {}
+    for part in parts:
+        for k, v in part.items():
+            if k == 'items':
+                continue
+            if k not in receipt or (v is not None and
+                                    (k in TOTAL_FIELDS or receipt[k] is None)):
+                receipt[k] = v
+    receipt['items'] = [item for part in parts for item in part.get('items') or ()]
+    return receipt
+
+def _continues(first, receipt):
+    # a receipt with no date and time of its own, or the same merchant, date
+    # and time as first, is more of first (the duplicate trip trigger would
+    # refuse it anyway)
+    date, time = receipt.get('date'), receipt.get('time')
+    if date is None and time is None:
+        return True
+    return ((date, time) == (first.get('date'), first.get('time'))
+            and receipt.get('merchant_name') in (None, first.get('merchant_name')))
+
+def group_parts(receipts):
+    # consecutive receipts that are pieces of the same one, as lists
+    groups = []
+    for receipt in receipts:
+        if groups and _continues(groups[-1][0], receipt):
+            groups[-1].append(receipt)
+        else:
+            groups.append([receipt])
+    return groups
+
+def response_receipts(responses):
+    """
+        the receipts in the api responses for the images of one capture.
+        A single photo can hold several receipts, and the api can also cut
+        one receipt into pieces, which group_parts puts back together.
+        Several images are the parts of one long receipt and always make
+        one receipt
+    """
+    receipts = [r for jobj in responses for r in jobj['receipts']]
+    if not receipts:
+        raise ValueError('No receipts in the response')
+    if len(responses) > 1:
+        return [stitch(receipts)]
+    return [stitch(group) for group in group_parts(receipts)]
+
+def load_rules(path):
+    """
+        reads a json rules file for headless loads, see split_rules.json.
+        Keys are all optional: creditor, debtor, debt_multiplier,
+        approve_discounts, merchants {pattern: overrides} and
+        items [{pattern, ...overrides}]
+    """
+    with open(path) as f:
+        rules = json.load(f)
+    rules['merchants'] = {re.compile(k, re.IGNORECASE):v
+                          for k, v in rules.get('merchants', {}).items()}
+    rules['items'] = [dict(r, pattern=re.compile(r['pattern'], re.IGNORECASE))
+                      for r in rules.get('items', [])]
+    return rules
+
+def merchant_split(ocr_name, rules):
+    # defaults, then the rules file, then the first matching merchant
+    split = {'creditor':DEFAULT_CREDITOR, 'debtor':DEFAULT_DEBTOR,
+             'debt_multiplier':DEFAULT_DEBT_MULTIPLIER}
+    split.update({k:rules[k] for k in SPLIT_COLUMNS if k in rules})
+    for pattern, overrides in rules['merchants'].items():
+        if ocr_name and pattern.search(ocr_name):
+            split.update({k:overrides[k] for k in SPLIT_COLUMNS if k in overrides})
+            break
+    return split
+
+def fold_discounts(item_cost, receipt):
+    """
+        one pass over the items of every receipt in a batch. Each negative
+        line becomes the discount of the line above it.
+        Returns (rows to keep, discount per row, receipts with a discount
+        that has no item above it)
+    """
+    is_discount = item_cost < 0
+    at = np.flatnonzero(is_discount)
+    above = np.maximum(at - 1, 0)
+    orphan = (at == 0) | (receipt[above] != receipt[at]) | is_discount[above]
+    discount = np.zeros(len(item_cost))
+    discount[above[~orphan]] = item_cost[at[~orphan]]
+    return ~is_discount, discount, set(receipt[at[orphan]].tolist())
+
+def match_items(descriptions, rules, split):
+    # first matching item rule wins, applied over the per-receipt split
+    matched = np.zeros(len(descriptions), dtype=bool)
+    for rule in rules['items']:
+        search = rule['pattern'].search
+        hit = ~matched & np.fromiter((bool(d) and search(d) is not None
+                                      for d in descriptions),
+                                     dtype=bool, count=len(descriptions))
+        for k in SPLIT_COLUMNS:
+            if k in rule:
+                split[k][hit] = rule[k]
+        matched |= hit
+
+def transform(receipts, rules):
+    """
+        receipts is a list of receipt dicts from the api. Returns a dict with
+          good: positions in receipts that produced rows
+          bad: [(position, error)] for receipts that didn't
+          merchants: merchant rows (dicts) for the good receipts, one per ocr_name
+          trips: (ocr_name, trip_datetime, subtotal, tax, total) per good receipt
+          items: purchase columns for every item of the good receipts, with
+                 'trip' the index into trips
+    """
+    bad = {}
+    merchants = {}
+    ok = []
+    trips = []
+    columns = {c:[] for c in ITEM_FIELDS.values()}
+    owner = []
+    for n, receipt in enumerate(receipts):
+        try:
+            merchant = parse_merchant(receipt)
+            trip = (merchant['ocr_name'], parse_trip_datetime(receipt),
+                    receipt['subtotal'], receipt['tax'], receipt['total'])
+            items = receipt['items']
+            if not items:
+                raise ValueError('Receipt has no items')
+            values = [[item.get(f) for item in items] for f in ITEM_FIELDS]
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            bad[n] = f'{type(e).__name__}: {e}'
+            continue
+        merchants.setdefault(merchant['ocr_name'], merchant)
+        ok.append(n)
+        trips.append(trip)
+        for column, v in zip(columns.values(), values):
+            column += v
+        owner += [len(trips) - 1] * len(items)
+
+    trip = np.array(owner, dtype=np.int64)
+    try:
+        item_cost = np.array(columns['item_cost'], dtype=float)
+    except (TypeError, ValueError):
+        # a non-numeric amount somewhere, find which receipts it's on
+        item_cost = np.array([_to_float(v) for v in columns['item_cost']])
+    broken = set(trip[np.isnan(item_cost)].tolist())
+    keep, discount, orphans = fold_discounts(item_cost, trip)
+    if not rules.get('approve_discounts', True):
+        # the rules say discounts need a person to look at them
+        for t in set(trip[~keep].tolist()) - orphans:
+            bad[ok[t]] = 'ValueError: Discount not approved'
+        orphans |= set(trip[~keep].tolist())
+    for t in orphans:
+        bad.setdefault(ok[t], 'ValueError: Discount row without an item above it')
+    for t in broken - orphans:
+        bad[ok[t]] = 'ValueError: Item amount is missing or not a number'
+    if orphans or broken:
+        keep &= ~np.isin(trip, list(orphans | broken))
+
+    # keep only the surviving rows and renumber trips without the bad ones
+    survivors = [t for t in range(len(trips)) if ok[t] not in bad]
+    renumber = np.full(len(trips) + 1, -1)
+    renumber[survivors] = np.arange(len(survivors))
+    rows = np.flatnonzero(keep)
+    items = {c:[v[i] for i in rows] for c, v in columns.items()}
+    items['item_cost'] = item_cost[rows]
+    items['discount'] = discount[rows]
+    items['trip'] = renumber[trip[rows]]
+    trips = [trips[t] for t in survivors]
+
+    # who pays: per receipt from the merchant, then per item
+    per_trip = [merchant_split(t[0], rules) for t in trips]
+    split = {k:np.array([s[k] for s in per_trip], dtype=float)[items['trip']]
+             if per_trip else np.zeros(0) for k in SPLIT_COLUMNS}
+    match_items(items['description'], rules, split)
+    items['creditor'] = split['creditor'].astype(np.int64)
+    items['debtor'] = split['debtor'].astype(np.int64)
+    items['debt_multiplier'] = split['debt_multiplier']
+
+    good = [ok[t] for t in survivors]
+    used = {t[0] for t in trips}
+    return {'good': good,
+            'bad': sorted(bad.items()),
+            'merchants': [m for name, m in merchants.items() if name in used],
+            'trips': trips,
+            'items': items}
+
+def subset(batch, keep):
+    # the batch with only the trips where keep is true, items renumbered
+    keep = np.asarray(keep, dtype=bool)
+    if keep.all():
+        return batch
+    renumber = np.cumsum(keep) - 1
+    rows = np.flatnonzero(keep[batch['items']['trip']])
+    items = {c:v[rows] if isinstance(v, np.ndarray) else [v[i] for i in rows]
+             for c, v in batch['items'].items()}
+    items['trip'] = renumber[items['trip']]
+    trips = [t for t, k in zip(batch['trips'], keep) if k]
+    used = {t[0] for t in trips}
+    return dict(batch, good=[g for g, k in zip(batch['good'], keep) if k], trips=trips,
+                merchants=[m for m in batch['merchants'] if m['ocr_name'] in used],
+                items=items)
+
+def _to_float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
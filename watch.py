@@ -0,0 +1,344 @@
+import os
+import queue
+import signal
+import threading
+from time import monotonic, sleep
+
+import bulk_load
+import database_manager as dm
+import dedup
+import ocr_api
+import preprocess
+import transform
+
+# Watches the receipts folder and streams every new image through
+#   OCR workers -> json parser -> one database writer
+# Stages are joined by bounded queues, so a slow stage makes the ones before
+# it wait instead of piling up work in memory. Images that already have a
+# json file skip the OCR, and the ingest journal skips files already loaded,
+# so restarting after a crash picks up whatever wasn't finished.
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None # poll the folder instead
+
+RECEIPTS_DIR = 'receipts'
+POLL_INTERVAL = 1.0 # seconds between folder scans without watchdog
+SETTLE = 1.0 # a file must keep its size this long before it is read
+QUEUE_SIZE = 16 # items waiting between two stages
+MAX_BATCH = 50 # receipts per database transaction
+LINGER = 0.2 # seconds the writer waits to fill a batch
+LATENCY_TARGET = 30.0 # seconds from image drop to committed receipt
+REPORT_EVERY = 60.0 # seconds between latency summaries
+PART_WAIT = 10.0 # seconds to wait for the next image of a long receipt
+
+_DONE = object() # tells the next stage to finish up
+
+def _put(q, item, stop):
+    # blocks while q is full, which is the backpressure on earlier stages
+    while True:
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            if stop.is_set() and item is not _DONE:
+                return False
+
+class Watcher:
+    def __init__(self, folder=RECEIPTS_DIR, rules_path='split_rules.json', workers=2,
+                 per_second=1.0, per_day=5, api_url=None, shrinker=None,
+                 use_cache=True, latency_target=LATENCY_TARGET, polling=False,
+                 deduplicator=None):
+        self.folder = folder
+        self.rules = transform.load_rules(rules_path)
+        self.workers = workers
+        self.limiter = ocr_api.RateLimiter(per_second, per_day)
+        self.session = ocr_api.get_session(pool_size=workers)
+        self.api_url = api_url
+        self.shrinker = shrinker
+        self.use_cache = use_cache
+        self.deduplicator = deduplicator
+        self.latency_target = latency_target
+        self.polling = polling or Observer is None
+        self.stop = threading.Event()
+        self.ocr_q = queue.Queue(QUEUE_SIZE)
+        self.parse_q = queue.Queue(QUEUE_SIZE)
+        self.write_q = queue.Queue(QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.pending = {} # path -> (size, mtime, first seen)
+        self.seen = {} # path -> (size, mtime) already sent down the pipeline
+        self.latencies = []
+        self.counts = {'ocr': 0, 'duplicate': 0, 'loaded': 0, 'skipped': 0,
+                       'quarantined': 0, 'failed': 0}
+
+    # discovery
+
+    def notice(self, path):
+        # a file was created or changed, it goes in once it stops changing
+        if not path.lower().endswith(ocr_api.IMAGE_EXTENSIONS):
+            return
+        with self.lock:
+            self.pending.setdefault(path, (None, None, monotonic()))
+
+    def scan(self):
+        for path in ocr_api.find_images(self.folder):
+            self.notice(path)
+
+    def ready(self):
+        # pending files whose size and mtime held still for SETTLE seconds
+        now = monotonic()
+        out = []
+        with self.lock:
+            for path, (size, mtime, since) in list(self.pending.items()):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    del self.pending[path]
+                    continue
+                current = (st.st_size, st.st_mtime_ns)
+                if current != (size, mtime):
+                    self.pending[path] = (*current, now)
+                elif now - since >= SETTLE:
+                    del self.pending[path]
+                    if self.seen.get(path) != current:
+                        self.seen[path] = current
+                        out.append((path, since))
+        return out
+
+    def discover(self):
+        last_scan = 0
+        while not self.stop.is_set():
+            if self.polling and monotonic() - last_scan >= POLL_INTERVAL:
+                self.scan()
+                last_scan = monotonic()
+            for path, since in self.ready():
+                # already recognized images go straight to the parser
+                json_file = ocr_api.json_path(path)
+                if os.path.exists(json_file):
+                    _put(self.parse_q, (path, json_file, since), self.stop)
+                else:
+                    _put(self.ocr_q, (path, since), self.stop)
+            sleep(0.1)
+        for _ in range(self.workers):
+            _put(self.ocr_q, _DONE, self.stop)
+        _put(self.parse_q, _DONE, self.stop)
+
+    # stages
+
+    def ocr(self):
+        while True:
+            item = self.ocr_q.get()
+            if item is _DONE:
+                _put(self.parse_q, _DONE, self.stop)
+                break
+            if self.stop.is_set():
+                continue # not started yet, the next run will find it
+            path, since = item
+            try:
+                jobj = ocr_api.get_json(path, use_cache=self.use_cache, shrinker=self.shrinker,
+                                        deduplicator=self.deduplicator,
+                                        session=self.session, limiter=self.limiter,
+                                        api_url=self.api_url)
+                ocr_api.write_json(jobj, path)
+            except dedup.DuplicateImage as e:
+                print(e)
+                self.count('duplicate')
+                continue
+            except ocr_api.DailyLimitReached as e:
+                # picked up again on the next start
+                print(f'{path}: {e}, not OCRed')
+                self.count('failed')
+                continue
+            except Exception as e:
+                print(f'{path}: OCR failed with {e!r}')
+                self.count('failed')
+                continue
+            self.count('ocr')
+            _put(self.parse_q, (path, ocr_api.json_path(path), since), self.stop)
+
+    def parse(self):
+        # reads, hashes and transforms each json file off the writer's thread.
+        # The parts of a long receipt (name_part1.jpg, ...) are held until no
+        # new part has come for PART_WAIT seconds and parsed together
+        finished = 0
+        captures = {} # capture -> (json files, first since, last part arrived)
+        while finished < self.workers + 1: # every ocr worker and discover
+            try:
+                item = self.parse_q.get(timeout=0.5)
+            except queue.Empty:
+                item = None
+            if item is _DONE:
+                finished += 1
+            elif item is not None:
+                path, json_file, since = item
+                part = bulk_load.capture_part(json_file)
+                if part is None:
+                    self.send([json_file], since)
+                else:
+                    files, first, _ = captures.get(part[0], ([], since, None))
+                    captures[part[0]] = (files + [json_file], min(first, since), monotonic())
+            for key, (files, since, last) in list(captures.items()):
+                if monotonic() - last >= PART_WAIT:
+                    del captures[key]
+                    self.send(files, since)
+        for files, since, _ in captures.values():
+            self.send(files, since)
+        _put(self.write_q, _DONE, self.stop)
+
+    def send(self, json_files, since):
+        parsed = bulk_load.parse_files(json_files, self.rules)
+        _put(self.write_q, (json_files[0], parsed, since), self.stop)
+
+    def write(self):
+        # the only stage that touches the database, in small batches
+        done = False
+        while not done:
+            items = [self.write_q.get()]
+            deadline = monotonic() + LINGER
+            while len(items) < MAX_BATCH and items[-1] is not _DONE:
+                try:
+                    items.append(self.write_q.get(timeout=max(0, deadline - monotonic())))
+                except queue.Empty:
+                    break
+            if items[-1] is _DONE:
+                items.pop()
+                done = True
+            if items:
+                self.write_batch(items)
+
+    def write_batch(self, items):
+        loaded = skipped = 0
+        quarantined = []
+        try:
+            with dm.transaction() as con:
+                for _, parsed, _ in items:
+                    n, _, s, q = bulk_load.write_parsed(parsed, con)
+                    loaded += n
+                    skipped += s
+                    quarantined += q
+        except Exception as e:
+            print(f'Writing {len(items)} receipts failed with {e!r}')
+            self.count('failed', len(items))
+            return
+        now = monotonic()
+        with self.lock:
+            self.counts['loaded'] += loaded
+            self.counts['skipped'] += skipped
+            self.counts['quarantined'] += len(quarantined)
+            self.latencies += [now - since for _, _, since in items]
+        for q in quarantined:
+            print(f"{q['file']}: quarantined, {q['error']}")
+        print(f'Committed {loaded} receipts')
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    # running
+
+    def latency_summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            counts = dict(self.counts)
+        text = ', '.join(f'{k} {v}' for k, v in counts.items())
+        if not latencies:
+            return text
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        met = 'within' if p95 <= self.latency_target else 'OVER'
+        return (f'{text}; drop to commit p50 {p50:.1f}s, p95 {p95:.1f}s, '
+                f'{met} the {self.latency_target:.0f}s target')
+
+    def run(self):
+        threads = [threading.Thread(target=self.discover, name='discover')]
+        threads += [threading.Thread(target=self.ocr, name=f'ocr{n}')
+                    for n in range(self.workers)]
+        threads += [threading.Thread(target=self.parse, name='parse'),
+                    threading.Thread(target=self.write, name='write')]
+        # before the observer, watchdog can't schedule a folder that isn't there
+        os.makedirs(self.folder, exist_ok=True)
+        observer = None
+        if not self.polling:
+            observer = Observer()
+            observer.schedule(_Handler(self), self.folder, recursive=False)
+            observer.start()
+        self.scan() # whatever arrived while we weren't running
+        for t in threads:
+            t.start()
+        print(f"Watching {self.folder} with {'polling' if self.polling else 'watchdog'}, "
+              f'{self.workers} OCR workers. Ctrl+C to stop')
+        last_report = monotonic()
+        try:
+            while not self.stop.is_set():
+                sleep(0.5)
+                if monotonic() - last_report >= REPORT_EVERY:
+                    print(self.latency_summary())
+                    last_report = monotonic()
+        except KeyboardInterrupt:
+            pass
+        print('Stopping, finishing receipts already in the pipeline...')
+        self.stop.set()
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        for t in threads:
+            t.join()
+        print(self.latency_summary())
+
+if Observer is not None:
+    class _Handler(FileSystemEventHandler):
+        def __init__(self, watcher):
+            self.watcher = watcher
+
+        def on_created(self, event):
+            if not event.is_directory:
+                self.watcher.notice(event.src_path)
+
+        def on_modified(self, event):
+            self.on_created(event)
+
+        def on_moved(self, event):
+            if not event.is_directory:
+                self.watcher.notice(event.dest_path)
+
+def add_arguments(parser):
+    parser.add_argument('folder', nargs='?', default=RECEIPTS_DIR)
+    parser.add_argument('--rules', default='split_rules.json')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--per-second', type=float, default=1.0)
+    parser.add_argument('--per-day', type=int, default=5,
+                        help='daily call budget, use 0 for no limit')
+    parser.add_argument('--url', default=None, help='override the api url')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--polling', action='store_true',
+                        help='scan the folder instead of using watchdog')
+    parser.add_argument('--latency-target', type=float, default=LATENCY_TARGET,
+                        help='seconds from image drop to committed receipt')
+    parser.add_argument('--shrink', action='store_true',
+                        help='shrink images before uploading, see preprocess.py')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='OCR photos even when they look like a receipt already sent')
+    parser.add_argument('--dedup-distance', type=int, default=dedup.MAX_DISTANCE,
+                        help='bits of the perceptual hash two photos of one receipt may differ by')
+    preprocess.add_arguments(parser)
+
+def run(args):
+    deduplicator = None
+    if not args.no_dedup:
+        deduplicator = dedup.open_deduplicator(max_distance=args.dedup_distance)
+    watcher = Watcher(args.folder, args.rules, args.workers, args.per_second,
+                      args.per_day or None, args.url,
+                      preprocess.from_args(args) if args.shrink else None,
+                      not args.no_cache, args.latency_target, args.polling, deduplicator)
+    # stop cleanly on a service manager's SIGTERM as well as Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: watcher.stop.set())
+    watcher.run()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Watch a folder and load new receipt images as they arrive')
+    add_arguments(parser)
+    run(parser.parse_args())